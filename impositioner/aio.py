@@ -0,0 +1,205 @@
+"""
+asyncio entry points for embedding impositioner in async applications
+
+CPU-bound imposition runs in an executor, so the event loop is never blocked.
+"""
+
+import asyncio
+import io
+from concurrent.futures import Executor
+from threading import Condition, Event
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Optional,
+    Union,
+)
+
+from pdfrw import PdfReader
+
+from . import cli, core
+
+CHUNK_SIZE: int = 64 * 1024
+# chunks a streaming job may write ahead of its reader
+STREAM_CHUNKS: int = 16
+
+Source = Union[bytes, bytearray, memoryview, AsyncIterable[bytes]]
+
+
+class Imposer:
+    """Imposes PDF files from byte streams, running at most max_jobs jobs at once.
+
+    Jobs run in executor, or in the default executor of the running loop if
+    executor is None.
+    """
+
+    def __init__(self, executor: Optional[Executor] = None, max_jobs: int = 4):
+        if max_jobs < 1:
+            raise ValueError("max_jobs must be greater than 0, is {}".format(max_jobs))
+        self.executor = executor
+        self.max_jobs = max_jobs
+        # created lazily, so that the semaphore belongs to the running loop
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def impose(self, source: Source, args: Optional[cli.Arguments] = None) -> bytes:
+        data = await read_source(source)
+        cancel = Event()
+        job = await self._start(impose_bytes, data, args or cli.Arguments(pdf=""), cancel)
+        try:
+            return await asyncio.shield(job)
+        except asyncio.CancelledError:
+            # stop the worker at its next step, it can't be interrupted otherwise
+            cancel.set()
+            raise
+
+    async def stream(
+        self, source: Source, args: Optional[cli.Arguments] = None, chunk_size: int = CHUNK_SIZE
+    ) -> AsyncIterator[bytes]:
+        args = args or cli.Arguments(pdf="")
+        if args.linearize:
+            # linearized output is rearranged after all pages are written
+            result = await self.impose(source, args)
+            view = memoryview(result)
+            for i in range(0, len(view), chunk_size):
+                yield bytes(view[i : i + chunk_size])
+                # give other tasks a chance to run between chunks
+                await asyncio.sleep(0)
+            return
+
+        # yield chunks while the worker is still writing later sheets
+        data = await read_source(source)
+        cancel = Event()
+        pipe = Pipe(asyncio.get_running_loop(), chunk_size, STREAM_CHUNKS)
+        job = await self._start(pipe_bytes, data, args, pipe, cancel)
+        try:
+            while True:
+                chunk = await pipe.read()
+                if not chunk:
+                    break
+                yield chunk
+            # raise error of the worker, if any
+            await asyncio.shield(job)
+        finally:
+            if not job.done():
+                # reader is gone, stop the worker at its next step or write
+                cancel.set()
+                pipe.abandon()
+
+    async def _start(self, func: Callable[..., Any], *args: Any) -> "asyncio.Future[Any]":
+        # run func in executor, once one of max_jobs slots is free
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_jobs)
+        semaphore = self._semaphore
+        await semaphore.acquire()
+        try:
+            job = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        except BaseException:
+            semaphore.release()
+            raise
+        # a cancelled job keeps running until the worker notices, so its slot is
+        # only released when the worker has finished
+        job.add_done_callback(lambda _: semaphore.release())
+        return job
+
+
+class Pipe:
+    """Binary file object, written by a worker thread and read in chunks in the event loop.
+
+    write blocks while limit chunks are waiting to be read, and raises
+    Cancelled once the reader has abandoned the pipe.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, chunk_size: int, limit: int):
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self.limit = chunk_size * limit
+        self._buffer = bytearray()
+        self._condition = Condition()
+        self._readable = asyncio.Event()
+        self._closed = False
+        self._abandoned = False
+
+    def write(self, data: bytes) -> int:
+        with self._condition:
+            while len(self._buffer) >= self.limit and not self._abandoned:
+                self._condition.wait()
+            if self._abandoned:
+                raise core.Cancelled("stream cancelled")
+            self._buffer.extend(data)
+            filled = len(self._buffer) - len(data) < self.chunk_size <= len(self._buffer)
+        if filled:
+            self.loop.call_soon_threadsafe(self._readable.set)
+        return len(data)
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+        self.loop.call_soon_threadsafe(self._readable.set)
+
+    def abandon(self) -> None:
+        with self._condition:
+            self._abandoned = True
+            self._condition.notify_all()
+
+    async def read(self) -> bytes:
+        # return next chunk of chunk_size bytes, a shorter last one, or an
+        # empty one once the pipe is closed
+        while True:
+            with self._condition:
+                if len(self._buffer) >= self.chunk_size or self._closed:
+                    chunk = bytes(self._buffer[: self.chunk_size])
+                    del self._buffer[: self.chunk_size]
+                    self._condition.notify_all()
+                    return chunk
+                self._readable.clear()
+            await self._readable.wait()
+
+
+async def read_source(source: Source) -> bytes:
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    buffer = bytearray()
+    async for chunk in source:
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def impose_bytes(data: bytes, args: cli.Arguments, cancel: Optional[Event] = None) -> bytes:
+    out = io.BytesIO()
+    write_imposed(data, args, out, cancel)
+    return out.getvalue()
+
+
+def pipe_bytes(data: bytes, args: cli.Arguments, pipe: Pipe, cancel: Optional[Event] = None) -> None:
+    try:
+        write_imposed(data, args, pipe, cancel)
+    finally:
+        pipe.close()
+
+
+def write_imposed(data: bytes, args: cli.Arguments, out: BinaryIO, cancel: Optional[Event] = None) -> None:
+    if args.linearize and core.pikepdf is None:
+        raise ValueError(core.LINEARIZE_MISSING)
+
+    # reject unusable uploads before they are parsed
+    report = core.preflight(io.BytesIO(data))
+    if report.issues:
+        raise ValueError("Unusable PDF file: {}".format("; ".join(issue.message for issue in report.issues)))
+
+    # invalid arguments make the core validators exit. SystemExit must not
+    # escape into an event loop, so report it as ValueError instead.
+    try:
+        reader = PdfReader(fdata=data)
+        sheets, _ = cli.impose_pages(reader.pages, args, None, cancel)
+    except core.InvalidInput as e:
+        raise ValueError(e.message)
+
+    core.write_pdf(sheets, out, reader.Info, None, cancel, args.linearize)
+
+
+async def impose(source: Source, args: Optional[cli.Arguments] = None, executor: Optional[Executor] = None) -> bytes:
+    """Impose a single PDF without concurrency limit and return the imposed PDF."""
+    return await Imposer(executor, max_jobs=1).impose(source, args)
@@ -3,16 +3,23 @@
 Main entry point for command-line program, invoke as `impositioner'
 """
 
+import json
 import math
+import os
+import shutil
+import signal
+import sys
 import textwrap
 from argparse import Action, ArgumentParser, RawDescriptionHelpFormatter
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from sys import exit
-from typing import List, Optional
+from threading import Event
+from typing import Collection, Dict, Iterator, List, Optional, Tuple
 
-from pdfrw import PdfReader
+from pdfrw import PdfDict, PdfReader
 
 from . import __version__, core
+from .streamwriter import CheckpointWriter, ContentHasher, StreamWriter
 
 
 @dataclass
@@ -27,6 +34,16 @@ class Arguments:
     outfolder: str = "./"
     divider: bool = False
     verbose: bool = False
+    progress: bool = False
+    cost: Optional[str] = None
+    dry_run: bool = False
+    signatures: Optional[str] = None
+    linearize: bool = False
+    checkpoint: bool = False
+    copies: int = 1
+    collate: bool = True
+    step_repeat: bool = False
+    incremental: bool = False
 
 
 class ListPaperFormatsAction(Action):
@@ -61,6 +78,9 @@ def parse_arguments() -> Arguments:
 
         Use custom output format and center each page before combining:
         $ %(prog)s -f 209.5x209.5 -c input.pdf
+
+        Repeat each page 8 times on an A4 sheet, e.g. for business cards:
+        $ %(prog)s -r -n 8 -f a4 cards.pdf
         """
         ),
     )
@@ -132,13 +152,83 @@ def parse_arguments() -> Arguments:
         default=-1,
         help="signature length. Set to 0 to disable signatures (default: set automatically)",
     )
+    parser.add_argument(
+        "-r",
+        dest="step_repeat",
+        action="store_true",
+        help="step and repeat: fill each sheet with N copies of a page, e.g. for cards and labels. Requires -f",
+    )
     parser.add_argument(
         "-d",
         dest="divider",
         action="store_true",
         help="insert blank sheets between signature stacks to ease separation after printing",
     )
+    parser.add_argument(
+        "-l",
+        dest="linearize",
+        action="store_true",
+        help="write linearized PDF for fast web view (requires pikepdf)",
+    )
+    parser.add_argument(
+        "--copies",
+        dest="copies",
+        metavar="N",
+        action="store",
+        type=int,
+        default=1,
+        help="repeat imposed sheets N times for printers without copy count (default: 1)",
+    )
+    parser.add_argument(
+        "--uncollated",
+        dest="collate",
+        action="store_false",
+        help="with --copies, repeat each sheet instead of the whole document (default: collated)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpoint",
+        action="store_true",
+        help=(
+            "write output signature by signature and record a checkpoint after each one. An interrupted job is"
+            " resumed when run again with the same arguments"
+        ),
+    )
+    parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help=(
+            "only impose signatures with pages changed since the last incremental run and append them to the"
+            " previous output as an incremental update"
+        ),
+    )
     parser.add_argument("-v", dest="verbose", action="store_true", help="Verbose output")
+    parser.add_argument("-p", dest="progress", action="store_true", help="show progress bar")
+    parser.add_argument(
+        "--signatures",
+        dest="signatures",
+        action="store",
+        metavar="LIST",
+        help="only impose these signatures, e.g. 3,7-9 to reprint single signatures (default: all)",
+    )
+    parser.add_argument(
+        "--cost",
+        dest="cost",
+        action="store",
+        metavar="COST",
+        help=(
+            "choose signature length by cost instead of fewest blank pages. Comma separated KEY=VALUE list with keys"
+            " blank, sheet, signature (cost per item) and min, max (signature length range), e.g."
+            " blank=1,sheet=0.5,signature=2,min=16,max=64 (default: blank=1,sheet=0,signature=0,min=20,max=36)"
+        ),
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="print signature plan as JSON and exit without imposing",
+    )
     parser.add_argument(
         "--list-formats",
         dest="list_formats",
@@ -159,59 +249,341 @@ def parse_arguments() -> Arguments:
         outfolder=args.outfolder,
         divider=args.divider,
         verbose=args.verbose,
+        progress=args.progress,
+        cost=args.cost,
+        dry_run=args.dry_run,
+        signatures=args.signatures,
+        linearize=args.linearize,
+        checkpoint=args.checkpoint,
+        copies=args.copies,
+        collate=args.collate,
+        step_repeat=args.step_repeat,
+        incremental=args.incremental,
     )
 
 
-def run(args: Arguments) -> None:
-    # validate arguments
-    infile: str = core.validate_infile(args.pdf)
-    signature_length: int = core.validate_signature_length(args.signature_length)
-    papersize: Optional[List[int]] = core.validate_papersize(args.paperformat, args.unit)
-    pages_per_sheet: int = core.validate_pages_per_sheet(args.nup)
-    center_subpage = args.center_subpage
-    binding = args.binding
-    divider = args.divider
-    outfolder = args.outfolder
-    verbose = args.verbose
+def print_progress(stage: str, done: int, total: int) -> None:
+    width = 40
+    filled = width * done // total if total else width
+    sys.stderr.write("\r{:<7} [{}{}] {:>5}/{}".format(stage, "#" * filled, "." * (width - filled), done, total))
+    if done == total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
 
-    # read pdf file
-    inpages: List = PdfReader(infile).pages
 
-    page_count: int = len(inpages)
+def plan(page_count: int, args: Arguments) -> Tuple[core.SignaturePlan, List[core.SignaturePlan]]:
+    # return chosen plan and all plans considered, cheapest first
+    signature_length: int = core.validate_signature_length(args.signature_length)
+    pages_per_sheet: int = core.validate_pages_per_sheet(args.nup)
+    cost_model = core.validate_cost_model(args.cost) if args.cost else core.CostModel()
 
     # calculate signature length, if not set manually through cli argument
     if signature_length == 0:
         # signatures are disabled, just pad to multiple of 4
         signature_length = page_count + core.reverse_remainder(page_count, 4)
     if signature_length < 0:
+        if args.cost:
+            plans = core.plan_signatures(page_count, pages_per_sheet, cost_model)
+            return plans[0], plans
         # calculate signature length
         signature_length = core.calculate_signature_length(page_count)
 
+    chosen = core.evaluate_plan(page_count, pages_per_sheet, signature_length, cost_model)
+    return chosen, [chosen]
+
+
+def prepare_pages(inpages: List, args: Arguments) -> Tuple[int, List[int]]:
+    # return signature length and selected signatures, pad inpages to full signatures
+    page_count: int = len(inpages)
+    signature_length: int = plan(page_count, args)[0].signature_length
     signature_count: int = math.ceil(page_count / signature_length)
 
+    signatures: List[int] = list(range(1, signature_count + 1))
+    if args.signatures:
+        signatures = core.validate_signatures(args.signatures)
+        if signatures[-1] > signature_count:
+            raise core.InvalidInput(
+                "Signature {} does not exist, there are {} signatures".format(signatures[-1], signature_count)
+            )
+
     # pad with blank pages
     blank_pages_count: int = signature_length * signature_count - page_count
     if blank_pages_count:
         inpages.extend([core.create_blank_copy(inpages[0])] * blank_pages_count)
 
+    return signature_length, signatures
+
+
+def impose_signature_sheets(
+    inpages: List,
+    signature_length: int,
+    signatures: List[int],
+    args: Arguments,
+    progress: Optional[core.Progress] = None,
+    cancel: Optional[Event] = None,
+    skip: Collection[int] = (),
+) -> Iterator[Tuple[int, List]]:
+    # yield number and sheets of each selected signature not in skip, ready to
+    # be written: imposed, resized and with divider pages in front of all but
+    # the first selected signature
+    papersize: Optional[List[int]] = core.validate_papersize(args.paperformat, args.unit)
+    pages_per_sheet: int = core.validate_pages_per_sheet(args.nup)
+
     # calculate output size of single page for centering content
     output_size: Optional[List[int]] = None
-    if papersize and center_subpage:
+    if papersize and args.center_subpage:
         output_size = core.calculate_scaled_sub_page_size(pages_per_sheet, papersize)
 
-    # impose and merge pages, creating sheets
-    sheets: List = core.impose_and_merge(inpages, signature_length, pages_per_sheet, output_size, binding)
+    for number, sheets in core.impose_signatures(
+        inpages,
+        signature_length,
+        pages_per_sheet,
+        output_size,
+        args.binding,
+        progress,
+        cancel,
+        [s for s in signatures if s not in skip],
+    ):
+        # resize result
+        if papersize:
+            sheets = core.resize(sheets, papersize)
+        # add divider pages
+        if args.divider and number != signatures[0]:
+            divider = core.create_blank_copy(sheets[0])
+            sheets = [divider, divider] + sheets
+        yield number, sheets
+
+
+def impose_pages(
+    inpages: List,
+    args: Arguments,
+    progress: Optional[core.Progress] = None,
+    cancel: Optional[Event] = None,
+) -> Tuple[List, int]:
+    # validate arguments
+    papersize: Optional[List[int]] = core.validate_papersize(args.paperformat, args.unit)
+    pages_per_sheet: int = core.validate_pages_per_sheet(args.nup)
 
-    # add divider pages
-    if divider:
-        sheets = core.add_divider(sheets, signature_length)
+    if args.step_repeat:
+        if not papersize:
+            raise core.InvalidInput("Step and repeat requires an output paper sheet format (-f)")
+        # signature and centering options don't apply to step and repeat
+        if args.signatures or args.divider or args.signature_length != -1 or args.center_subpage or args.cost:
+            raise core.InvalidInput("Step and repeat can't be combined with --signatures, -d, -s, -c or --cost")
+        # each page fills a sheet of its own, there are no signatures
+        sheets: List = core.step_and_repeat(inpages, pages_per_sheet, papersize, progress, cancel)
+        signature_length: int = 0
+    else:
+        signature_length, signatures = prepare_pages(inpages, args)
+        sheets = []
+        for _, signature in impose_signature_sheets(inpages, signature_length, signatures, args, progress, cancel):
+            sheets.extend(signature)
+
+    # repeat sheets
+    copies: int = core.validate_copies(args.copies)
+    if copies > 1:
+        sheets = core.copy_sheets(sheets, copies, args.collate)
+
+    return sheets, signature_length
+
+
+def save_checkpointed(
+    infile: str,
+    inpages: List,
+    args: Arguments,
+    info: Optional[PdfDict],
+    progress: Optional[core.Progress] = None,
+    cancel: Optional[Event] = None,
+) -> Tuple[int, int]:
+    # impose and write signature by signature. an interrupted job leaves a
+    # partial file and checkpoint, and is resumed when run again with the same
+    # input and arguments. returns signature length and number of sheets.
+    signature_length, signatures = prepare_pages(inpages, args)
+
+    outfn = core.create_outfile(infile, args.outfolder)
+    writer = CheckpointWriter(outfn + ".part")
+    stat = os.stat(infile)
+    options = {k: v for k, v in asdict(args).items() if k not in ("verbose", "progress", "checkpoint")}
+    job = json.dumps([infile, stat.st_size, stat.st_mtime_ns, options], sort_keys=True)
+    finished = writer.open(job)
+
+    try:
+        for number, sheets in impose_signature_sheets(
+            inpages, signature_length, signatures, args, progress, cancel, range(1, finished + 1)
+        ):
+            writer.add_signature(number, sheets)
+        # a job cancelled after its last step must not replace the output
+        core.check_cancelled(cancel, "save")
+        writer.close(info)
+    except BaseException:
+        writer.abort()
+        raise
+
+    os.replace(writer.fname, outfn)
+    return signature_length, len(writer.pages)
+
+
+def read_manifest(fname: str, outfn: str, options: Dict) -> Optional[Dict]:
+    # return manifest of the previous incremental run, if it was made with the
+    # same options and still describes the current output file
+    try:
+        with open(fname) as f:
+            manifest = json.load(f)
+        stat = os.stat(outfn)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("options") != options or manifest.get("output") != [stat.st_size, stat.st_mtime_ns]:
+        return None
+    return manifest
+
+
+def save_incremental(
+    infile: str,
+    inpages: List,
+    args: Arguments,
+    info: Optional[PdfDict],
+    progress: Optional[core.Progress] = None,
+    cancel: Optional[Event] = None,
+) -> Tuple[int, int, int]:
+    # impose only signatures with pages changed since the last incremental run
+    # and append them to the previous output as a PDF incremental update. the
+    # sheets of all other signatures stay where they are. a manifest next to
+    # the output records the fingerprints of the pages of each signature, the
+    # numbers of its sheets and the objects in the output. returns signature
+    # length, number of sheets and number of reused signatures.
+    signature_length, all_signatures = prepare_pages(inpages, args)
+
+    hasher = ContentHasher()
+    fingerprints = [core.fingerprint_page(page, hasher) for page in inpages]
+    signature_pages = list(core.cut_in_signatures(fingerprints, signature_length))
+
+    outfn = core.create_outfile(infile, args.outfolder)
+    manifest_fn = outfn + ".manifest"
+    options = {k: v for k, v in asdict(args).items() if k not in ("verbose", "progress", "incremental")}
+    manifest = read_manifest(manifest_fn, outfn, options)
+    if manifest and manifest["signature_length"] != signature_length:
+        manifest = None
+
+    # find unchanged signatures in previous output
+    reused: Dict[int, List[int]] = {}
+    dead: int = 0
+    if manifest:
+        previous = manifest["signatures"]
+        for number, (entry, pages) in enumerate(zip(previous, signature_pages), 1):
+            if entry["fingerprints"] == pages:
+                reused[number] = entry["sheets"]
+        if len(reused) == len(signature_pages) == len(previous):
+            # nothing changed, the output is still up to date
+            return signature_length, sum(len(sheets) for sheets in reused.values()), len(reused)
+
+        # replaced sheets stay in the file. once they outnumber the sheets in
+        # use, write the whole output again instead
+        live = sum(len(sheets) for sheets in reused.values())
+        dead = manifest["dead"] + sum(len(entry["sheets"]) for entry in previous) - live
+        if dead > live:
+            reused, dead, manifest = {}, 0, None
+
+    tmpfn = outfn + ".part"
+    if manifest:
+        shutil.copyfile(outfn, tmpfn)
+        writer = StreamWriter(open(tmpfn, "ab"))
+        writer.start_update(manifest["objects"], manifest["next_objnum"], manifest["xref"], os.path.getsize(tmpfn))
+    else:
+        writer = StreamWriter(open(tmpfn, "wb"))
+        writer.start()
+
+    signatures = []
+    try:
+        imposed = impose_signature_sheets(inpages, signature_length, all_signatures, args, progress, cancel, reused)
+        for number, pages in enumerate(signature_pages, 1):
+            first = len(writer.pages)
+            if number in reused:
+                writer.pages.extend(reused[number])
+            else:
+                _, sheets = next(imposed)
+                for sheet in sheets:
+                    writer.add_page(sheet)
+            signatures.append({"fingerprints": pages, "sheets": writer.pages[first:]})
+        # a job cancelled after its last step must not replace the output
+        core.check_cancelled(cancel, "save")
+        writer.close(info)
+        writer.f.close()
+    except BaseException:
+        writer.f.close()
+        os.remove(tmpfn)
+        raise
+    os.replace(tmpfn, outfn)
+
+    stat = os.stat(outfn)
+    manifest = {
+        "options": options,
+        "output": [stat.st_size, stat.st_mtime_ns],
+        "signature_length": signature_length,
+        "signatures": signatures,
+        "objects": writer.objects,
+        "next_objnum": writer.next_objnum,
+        "xref": writer.xref,
+        "dead": dead,
+    }
+    with open(manifest_fn + ".part", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_fn + ".part", manifest_fn)
+    return signature_length, len(writer.pages), len(reused)
+
+
+def run(args: Arguments, cancel: Optional[Event] = None) -> None:
+    infile: str = core.validate_infile(args.pdf)
+    progress: Optional[core.Progress] = print_progress if args.progress else None
+    core.validate_linearize(args.linearize)
+    if args.checkpoint and args.linearize:
+        raise core.InvalidInput("Linearized output can't be written with checkpoints")
+    if args.checkpoint and args.copies > 1:
+        raise core.InvalidInput("Copies can't be written with checkpoints")
+    if args.checkpoint and args.step_repeat:
+        raise core.InvalidInput("Step and repeat can't be written with checkpoints")
+    if args.incremental and (
+        args.checkpoint or args.linearize or args.step_repeat or args.copies > 1 or args.signatures
+    ):
+        raise core.InvalidInput(
+            "Incremental mode can't be combined with --checkpoint, -l, -r, --copies or --signatures"
+        )
+
+    if args.dry_run:
+        # preflight counts pages without parsing the whole file, if it can
+        counted = core.preflight(infile).page_count
+        page_count: int = counted if counted is not None else len(PdfReader(infile).pages)
+        chosen, plans = plan(page_count, args)
+        result = {
+            "pdf": infile,
+            "page_count": page_count,
+            "pages_per_sheet": args.nup,
+            "plan": asdict(chosen),
+            "candidates": [asdict(p) for p in plans],
+        }
+        print(json.dumps(result, indent=2))
+        return
 
-    # resize result
-    if papersize:
-        sheets = core.resize(sheets, papersize)
+    # read pdf file
+    reader: PdfReader = PdfReader(infile)
+    inpages: List = reader.pages
+    page_count = len(inpages)
+    input_size = inpages[0].MediaBox[2:]
+
+    if args.checkpoint:
+        # impose and save imposed pdf signature by signature
+        signature_length, sheet_count = save_checkpointed(infile, inpages, args, reader.Info, progress, cancel)
+        output_size = None
+    elif args.incremental:
+        # impose changed signatures and save imposed pdf
+        signature_length, sheet_count, reused = save_incremental(infile, inpages, args, reader.Info, progress, cancel)
+        output_size = None
+    else:
+        sheets, signature_length = impose_pages(inpages, args, progress, cancel)
+        sheet_count = len(sheets)
+        output_size = sheets[0].MediaBox[2:]
 
     # print infos
-    if verbose:
+    if args.verbose:
         for line in textwrap.wrap(
             "Standard paper formats: {}".format(", ".join(sorted(core.paperformats.keys()))),
             80,
@@ -219,25 +591,52 @@ def run(args: Arguments) -> None:
             print(line)
 
         print("Total input page:  {:>3}".format(page_count))
-        print("Total output page: {:>3}".format(len(sheets)))
-
-        input_size = inpages[0].MediaBox[2:]
-        output_size = sheets[0].MediaBox[2:]
-        divider_count = 2 * signature_count - 2 if divider else 0
+        print("Total output page: {:>3}".format(sheet_count))
 
         print("Input size:        {}x{}".format(input_size[0], input_size[1]))
-        print("Output size:       {}x{}".format(output_size[0], output_size[1]))
-        print("Signature length:  {:>3}".format(signature_length))
-        print("Signature count:   {:>3}".format(signature_count))
-        print("Divider pages:     {:>3}".format(divider_count))
+        if output_size:
+            print("Output size:       {}x{}".format(output_size[0], output_size[1]))
+
+        if signature_length:
+            signature_count: int = math.ceil(page_count / signature_length)
+            divider_count = 2 * signature_count - 2 if args.divider else 0
+            print("Signature length:  {:>3}".format(signature_length))
+            print("Signature count:   {:>3}".format(signature_count))
+            print("Divider pages:     {:>3}".format(divider_count))
+        if args.incremental:
+            print("Reused signatures: {:>3}".format(reused))
 
     # save imposed pdf
-    core.save_pdf(infile, sheets, outfolder)
-    print("Imposed PDF file saved to {}".format(core.create_outfile(infile, outfolder)))
+    if not (args.checkpoint or args.incremental):
+        core.save_pdf(infile, sheets, args.outfolder, progress, cancel, reader.Info, args.linearize)
+    print("Imposed PDF file saved to {}".format(core.create_outfile(infile, args.outfolder)))
 
 
 def main():
-    return run(args=parse_arguments())
+    args = parse_arguments()
+
+    # first ctrl-c stops the job cleanly at the next step, second one aborts
+    cancel = Event()
+
+    def interrupt(signum, frame):
+        if cancel.is_set():
+            raise KeyboardInterrupt
+        cancel.set()
+
+    signal.signal(signal.SIGINT, interrupt)
+    try:
+        return run(args, cancel)
+    except core.InvalidInput as e:
+        print(e.message)
+        return 1
+    except core.Cancelled:
+        if args.checkpoint:
+            print("\nCancelled, run again with the same arguments to resume after the last finished signature")
+        elif args.incremental:
+            print("\nCancelled, previous output kept")
+        else:
+            print("\nCancelled, no output written")
+        return 1
 
 
 if __name__ == "__main__":
@@ -15,15 +15,44 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>
 
+import hashlib
+import io
 import math
 import os
 import re
 import sys
-from typing import Any, Dict, Iterator, List, Optional, Tuple
+import warnings
+import zlib
+from dataclasses import dataclass, field
+from threading import Event
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Collection,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import pdfrw.pagemerge
-from pdfrw import PageMerge, PdfReader, PdfWriter
+from pdfrw import IndirectPdfDict, PageMerge, PdfArray, PdfName, PdfReader
+from pdfrw.buildxobj import pagexobj
 from pdfrw.objects.pdfdict import PdfDict
+from pdfrw.pdfwriter import user_fmt
+
+from .streamwriter import ContentHasher, StreamWriter
+
+# optional, only needed for linearized output
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
+
+LINEARIZE_MISSING = "Linearized output requires pikepdf, install it with: pip install pikepdf"
 
 paperformats: Dict[str, List[int]] = {
     "a0": [2384, 3371],
@@ -47,6 +76,37 @@ paperformats: Dict[str, List[int]] = {
 # dots per unit
 units: Dict[str, float] = {"mm": 2.834, "cm": 28.34, "inch": 72}
 
+# progress callback, called with stage name, finished steps and total steps
+Progress = Callable[[str, int, int], None]
+
+
+class Cancelled(Exception):
+    """Raised when a job is stopped through its cancel event."""
+
+
+class InvalidInput(SystemExit):
+    """Raised for invalid arguments or input files.
+
+    A SystemExit, so that the command line tool exits with an error. The
+    reason is kept in message for callers that report it otherwise.
+    """
+
+    def __init__(self, message: str):
+        super().__init__(1)
+        self.message = message
+
+
+def check_cancelled(cancel: Optional[Event], stage: str) -> None:
+    if cancel is not None and cancel.is_set():
+        raise Cancelled("{} cancelled".format(stage))
+
+
+def report_progress(progress: Optional[Progress], cancel: Optional[Event], stage: str, done: int, total: int) -> None:
+    # cancellation is cooperative: it is checked every time progress is reported
+    check_cancelled(cancel, "{} after {} of {} steps".format(stage, done, total))
+    if progress is not None:
+        progress(stage, done, total)
+
 
 def reverse_remainder(dividend: int, divisor: int) -> int:
     reverse_remainder = 0
@@ -55,6 +115,11 @@ def reverse_remainder(dividend: int, divisor: int) -> int:
     return reverse_remainder
 
 
+def shortest_signature_length(page_count: int) -> int:
+    # return shortest signature length, a multiple of 4, holding page_count pages
+    return max(4, page_count + reverse_remainder(page_count, 4))
+
+
 def calculate_signature_length(page_count: int) -> int:
     # return page_count as signature_length if page_count too low
     if page_count <= 36:
@@ -75,6 +140,57 @@ def calculate_signature_length(page_count: int) -> int:
     return signature_length
 
 
+@dataclass
+class CostModel:
+    # cost per blank page, per printed sheet and per signature to fold and bind
+    blank_page: float = 1.0
+    sheet: float = 0.0
+    signature: float = 0.0
+    # range of signature lengths to consider
+    min_length: int = 20
+    max_length: int = 36
+
+
+@dataclass
+class SignaturePlan:
+    signature_length: int
+    signature_count: int
+    blank_pages: int
+    sheets: int
+    cost: float
+
+
+def evaluate_plan(page_count: int, pages_per_sheet: int, signature_length: int, cost_model: CostModel) -> SignaturePlan:
+    signature_count = math.ceil(page_count / signature_length)
+    # each signature is padded to full sheets with front- and backside
+    signature_pages = signature_length + reverse_remainder(signature_length, 2 * pages_per_sheet)
+    blank_pages = signature_count * signature_pages - page_count
+    sheets = signature_count * signature_pages // (2 * pages_per_sheet)
+    cost = cost_model.blank_page * blank_pages + cost_model.sheet * sheets + cost_model.signature * signature_count
+    return SignaturePlan(signature_length, signature_count, blank_pages, sheets, cost)
+
+
+def candidate_signature_lengths(page_count: int, cost_model: CostModel) -> List[int]:
+    # all multiples of 4 in range of cost model. a single signature holding the
+    # whole document is always allowed, even if it is shorter than min_length
+    whole = shortest_signature_length(page_count)
+    lower = shortest_signature_length(cost_model.min_length)
+    lengths = list(range(lower, min(cost_model.max_length, whole) + 1, 4))
+    if whole <= cost_model.max_length and whole not in lengths:
+        lengths.append(whole)
+    return lengths
+
+
+def plan_signatures(page_count: int, pages_per_sheet: int, cost_model: CostModel) -> List[SignaturePlan]:
+    # return plans for all candidate lengths, cheapest first. if two plans cost
+    # the same, the one with larger signatures comes first.
+    plans = [
+        evaluate_plan(page_count, pages_per_sheet, length, cost_model)
+        for length in candidate_signature_lengths(page_count, cost_model)
+    ]
+    return sorted(plans, key=lambda plan: (plan.cost, -plan.signature_length))
+
+
 def cut_in_signatures(inpages: List, signature_length: int) -> Iterator[List]:
     for i in range(0, len(inpages), signature_length):
         yield inpages[i : i + signature_length]
@@ -116,8 +232,7 @@ def set_binding(page: pdfrw.pagemerge.PageMerge, binding: str, rotation: int) ->
         page[1].y += page[0].h
         page.rotate = rotation if not is_landscape(page) else 0
     else:
-        print("Unknown binding:", binding)
-        sys.exit(1)
+        raise InvalidInput("Unknown binding: {}".format(binding))
     return page
 
 
@@ -145,6 +260,67 @@ def calculate_scaled_sub_page_size(pages_per_sheet: int, papersize: List[int]) -
         return [int(round(papersize[0] / columns)), int(round(papersize[1] / rows))]
 
 
+def calculate_grid(
+    pages_per_sheet: int, papersize: List[int], landscape: bool
+) -> Tuple[List[int], List[int], int, int]:
+    # return sheet size, cell size, columns and rows of a grid with
+    # pages_per_sheet cells sized by calculate_scaled_sub_page_size. landscape
+    # selects the orientation of the cells, the sheet is rotated accordingly.
+    cell = calculate_scaled_sub_page_size(pages_per_sheet, papersize)
+    sheet = list(papersize)
+    if round(sheet[0] / cell[0]) * round(sheet[1] / cell[1]) != pages_per_sheet:
+        sheet = list(reversed(sheet))
+    if (cell[0] > cell[1]) != landscape:
+        sheet, cell = list(reversed(sheet)), list(reversed(cell))
+    return sheet, cell, round(sheet[0] / cell[0]), round(sheet[1] / cell[1])
+
+
+def grid_content(rect: Tuple[float, float, float, float], cell: List[int], columns: int, rows: int) -> str:
+    # return content stream placing form xobject /P with rect in each cell
+    x, y, w, h = rect
+    scale, x_margin, y_margin = calculate_margins(cell, [w, h])
+    ops = []
+    for row in range(rows):
+        for column in range(columns):
+            tx = column * cell[0] + x_margin - scale * x
+            ty = row * cell[1] + y_margin - scale * y
+            ops.append("q {0} 0 0 {0} {1} {2} cm /P Do Q".format(user_fmt(scale), user_fmt(tx), user_fmt(ty)))
+    return "\n".join(ops)
+
+
+def step_and_repeat(
+    inpages: List,
+    pages_per_sheet: int,
+    papersize: List[int],
+    progress: Optional[Progress] = None,
+    cancel: Optional[Event] = None,
+) -> List:
+    # fill a sheet with copies of each page. every page becomes a single form
+    # xobject, which is placed in all cells by reference. sheets of pages with
+    # the same size share their content stream.
+    landscape = is_landscape_size(get_media_box_size(inpages))
+    sheet_size, cell, columns, rows = calculate_grid(pages_per_sheet, papersize, landscape)
+    contents: Dict[Tuple[float, float, float, float], PdfDict] = {}
+
+    sheets = []
+    report_progress(progress, cancel, "repeat", 0, len(inpages))
+    for idx, page in enumerate(inpages):
+        xobj = pagexobj(page)
+        rect = (xobj.x, xobj.y, xobj.w, xobj.h)
+        if rect not in contents:
+            contents[rect] = PdfDict(indirect=True, stream=grid_content(rect, cell, columns, rows))
+        sheets.append(
+            IndirectPdfDict(
+                Type=PdfName.Page,
+                MediaBox=PdfArray([0, 0] + sheet_size),
+                Resources=PdfDict(XObject=PdfDict(P=xobj)),
+                Contents=contents[rect],
+            )
+        )
+        report_progress(progress, cancel, "repeat", idx + 1, len(inpages))
+    return sheets
+
+
 def add_blanks(signature: List, pages_per_sheet: int) -> List:
     remainder = len(signature) % (2 * pages_per_sheet)
     s = list(signature)
@@ -178,7 +354,12 @@ def calculate_margins(output_size, current_size) -> Tuple[Any, float, float]:
     return scale, x_margin, y_margin
 
 
-def resize(outpages: List, output_size: List[int]) -> List:
+def resize(
+    outpages: List,
+    output_size: List[int],
+    progress: Optional[Progress] = None,
+    cancel: Optional[Event] = None,
+) -> List:
     current_size = get_media_box_size(outpages)
     o = list(outpages)
 
@@ -190,6 +371,7 @@ def resize(outpages: List, output_size: List[int]) -> List:
 
     scale, x_margin, y_margin = calculate_margins(output_size, current_size)
 
+    report_progress(progress, cancel, "resize", 0, len(outpages))
     for idx, page in enumerate(outpages):
         page = PageMerge().add(page)
 
@@ -203,20 +385,326 @@ def resize(outpages: List, output_size: List[int]) -> List:
 
         # replace original with resized page
         o[idx] = page.render()
+        report_progress(progress, cancel, "resize", idx + 1, len(outpages))
 
     return o
 
 
+def is_landscape_size(size: List[int]) -> bool:
+    return size[0] > size[1]
+
+
 def is_landscape(page: pdfrw.pagemerge.PageMerge) -> Any:
     dim = page.xobj_box[2:]
     return dim[0] > dim[1]
 
 
+# size of blocks read backwards from end of file by preflight
+PREFLIGHT_BLOCK = 2048
+# startxref is only searched for in this many bytes at the end of the file
+PREFLIGHT_TAIL = 1024 * 1024
+# xref and object streams are decoded up to this many bytes
+PREFLIGHT_STREAM = 32 * 1024 * 1024
+
+
+@dataclass
+class PreflightIssue:
+    code: str
+    message: str
+
+
+@dataclass
+class PreflightReport:
+    version: Optional[str] = None
+    # None if page count could not be determined cheaply
+    page_count: Optional[int] = None
+    encrypted: bool = False
+    issues: List[PreflightIssue] = field(default_factory=list)
+
+
+def read_at(f: BinaryIO, offset: int, size: int) -> bytes:
+    f.seek(offset)
+    return f.read(size)
+
+
+def read_xref_table(f: BinaryIO, xref_offset: int) -> Tuple[List[Tuple[int, int, int]], int]:
+    # return subsections of the classic xref table at xref_offset as first
+    # object number, count and offset of first entry, and the offset after it
+    subsections = []
+    position = xref_offset + 4
+    while True:
+        # subsection header "start count", followed by entries of 20 bytes
+        match = re.match(rb"\s*(\d+) (\d+)\s*", read_at(f, position, 64))
+        if not match:
+            return subsections, position
+        start, count = int(match.group(1)), int(match.group(2))
+        position += match.end()
+        subsections.append((start, count, position))
+        position += 20 * count
+
+
+def xref_sections(f: BinaryIO, xref_offset: int) -> Iterator[Tuple[int, bytes]]:
+    # yield offset and trailer dictionary of each xref section, newest first,
+    # following /Prev of incremental updates and linearized files. xref
+    # streams hold their trailer in the stream dictionary.
+    seen = set()
+    while xref_offset not in seen and len(seen) < 32:
+        seen.add(xref_offset)
+        data = read_at(f, xref_offset, 4096)
+        if data.startswith(b"xref"):
+            position = read_xref_table(f, xref_offset)[1]
+            trailer = read_at(f, position, 4096).split(b"startxref")[0]
+            if not trailer.startswith(b"trailer"):
+                return
+        elif re.match(rb"\d+\s+\d+\s+obj", data):
+            trailer = data.split(b"stream")[0]
+        else:
+            return
+        yield xref_offset, trailer
+        prev = re.search(rb"/Prev\s+(\d+)", trailer)
+        if not prev:
+            return
+        xref_offset = int(prev.group(1))
+
+
+def read_stream(f: BinaryIO, offset: int) -> Optional[Tuple[bytes, bytes]]:
+    # return dictionary and decoded data of the stream object at offset, or
+    # None if its length is indirect or its filter is not supported
+    data = read_at(f, offset, 4096)
+    match = re.search(rb"\bstream\r?\n", data)
+    if not match:
+        return None
+    dictionary = data[: match.start()]
+    length = re.search(rb"/Length\s+(\d+)(\s+\d+\s+R)?", dictionary)
+    if not length or length.group(2):
+        return None
+    stream = read_at(f, offset + match.end(), int(length.group(1)))
+
+    filters = re.search(rb"/Filter\s*(\[[^\]]*\]|/\w+)", dictionary)
+    names = re.findall(rb"/(\w+)", filters.group(1)) if filters else []
+    if names == [b"FlateDecode"]:
+        try:
+            stream = zlib.decompressobj().decompress(stream, PREFLIGHT_STREAM)
+        except zlib.error:
+            return None
+    elif names:
+        return None
+    return dictionary, stream
+
+
+def predicted_row(stream: bytes, width: int, index: int) -> bytes:
+    # return row index of png predicted rows of width bytes, each preceded by
+    # its predictor type
+    stride = width + 1
+    end = (index + 1) * stride
+    if len(stream) < end:
+        return b""
+    if set(stream[0:end:stride]) <= {2}:
+        # xref streams use predictor up only: each byte is the sum of its
+        # column up to the row
+        return bytes(sum(stream[1 + x : end : stride]) & 255 for x in range(width))
+
+    previous = row = bytearray(width)
+    for i in range(0, end, stride):
+        kind, row = stream[i], bytearray(stream[i + 1 : i + stride])
+        for x in range(width):
+            left = row[x - 1] if x else 0
+            up = previous[x]
+            upleft = previous[x - 1] if x else 0
+            if kind == 1:
+                row[x] = (row[x] + left) % 256
+            elif kind == 2:
+                row[x] = (row[x] + up) % 256
+            elif kind == 3:
+                row[x] = (row[x] + (left + up) // 2) % 256
+            elif kind == 4:
+                estimate = left + up - upleft
+                nearest = min(
+                    (abs(estimate - left), 0, left), (abs(estimate - up), 1, up), (abs(estimate - upleft), 2, upleft)
+                )
+                row[x] = (row[x] + nearest[2]) % 256
+        previous = row
+    return bytes(row)
+
+
+def read_xref_stream(f: BinaryIO, xref_offset: int, objnum: int) -> Optional[Tuple[int, int, int]]:
+    # return type and fields of the entry of objnum in the xref stream at
+    # xref_offset, or None if the stream has no entry for objnum
+    result = read_stream(f, xref_offset)
+    if result is None:
+        return None
+    dictionary, data = result
+    widths = re.search(rb"/W\s*\[\s*(\d+)\s+(\d+)\s+(\d+)\s*\]", dictionary)
+    size = re.search(rb"/Size\s+(\d+)", dictionary)
+    if not widths or not size:
+        return None
+    widths = [int(w) for w in widths.groups()]
+    index = re.search(rb"/Index\s*\[([\d\s]*)\]", dictionary)
+    numbers = [int(n) for n in index.group(1).split()] if index else [0, int(size.group(1))]
+
+    predictor = re.search(rb"/Predictor\s+(\d+)", dictionary)
+    predicted = predictor is not None and int(predictor.group(1)) >= 10
+
+    row = 0
+    for start, count in zip(numbers[::2], numbers[1::2]):
+        if start <= objnum < start + count:
+            row += objnum - start
+            if predicted:
+                entry = predicted_row(data, sum(widths), row)
+            else:
+                entry = data[row * sum(widths) : (row + 1) * sum(widths)]
+            if len(entry) < sum(widths):
+                return None
+            fields = []
+            for width in widths:
+                fields.append(int.from_bytes(entry[:width], "big"))
+                entry = entry[width:]
+            # type defaults to 1 if its field is missing
+            if not widths[0]:
+                fields[0] = 1
+            return fields[0], fields[1], fields[2]
+        row += count
+    return None
+
+
+def find_object(f: BinaryIO, xref_offset: int, objnum: int) -> Optional[Tuple[int, int, int]]:
+    # return xref entry of objnum as type and fields: type 1 with offset of the
+    # object, or type 2 with number of its object stream and index in it.
+    # classic xref tables only hold type 1 entries.
+    for offset, trailer in xref_sections(f, xref_offset):
+        if read_at(f, offset, 4) == b"xref":
+            for start, count, position in read_xref_table(f, offset)[0]:
+                if start <= objnum < start + count:
+                    entry = re.match(rb"(\d{10}) \d{5} ([nf])", read_at(f, position + 20 * (objnum - start), 20))
+                    return (1, int(entry.group(1)), 0) if entry and entry.group(2) == b"n" else None
+            # hybrid files keep compressed objects in an additional xref stream
+            stream = re.search(rb"/XRefStm\s+(\d+)", trailer)
+            entry = read_xref_stream(f, int(stream.group(1)), objnum) if stream else None
+        else:
+            entry = read_xref_stream(f, offset, objnum)
+        if entry is not None:
+            return entry if entry[0] in (1, 2) else None
+    return None
+
+
+def load_object(f: BinaryIO, xref_offset: int, objnum: int) -> Optional[bytes]:
+    # return start of object objnum, from the file or from an object stream
+    entry = find_object(f, xref_offset, objnum)
+    if entry is None:
+        return None
+    if entry[0] == 1:
+        return read_object(f, entry[1])
+
+    container = find_object(f, xref_offset, entry[1])
+    result = read_stream(f, container[1]) if container and container[0] == 1 else None
+    if result is None:
+        return None
+    dictionary, data = result
+    first = re.search(rb"/First\s+(\d+)", dictionary)
+    if not first:
+        return None
+    # header of object stream is a list of object numbers and offsets
+    header = [int(n) for n in re.findall(rb"\d+", re.sub(rb"%[^\r\n]*", b"", data[: int(first.group(1))]))]
+    offsets = header[1::2] + [len(data) - int(first.group(1))]
+    index = entry[2]
+    if index >= len(header) // 2 or header[2 * index] != objnum:
+        return None
+    return data[int(first.group(1)) + offsets[index] : int(first.group(1)) + offsets[index + 1]]
+
+
+def find_startxref(f: BinaryIO, size: int) -> Optional[int]:
+    # return offset of the last startxref within PREFLIGHT_TAIL bytes from the
+    # end, reading the file backwards in blocks. blocks overlap, so that a
+    # keyword across a block border is found
+    position = size
+    while position > max(0, size - PREFLIGHT_TAIL):
+        start = max(0, size - PREFLIGHT_TAIL, position - PREFLIGHT_BLOCK)
+        found = read_at(f, start, position - start + 8).rfind(b"startxref")
+        if found >= 0:
+            return start + found
+        position = start
+    return None
+
+
+def read_object(f: BinaryIO, offset: int) -> bytes:
+    # return start of object at offset up to endobj, at most 4 kB
+    data = read_at(f, offset, 4096)
+    return data[: data.find(b"endobj")] if b"endobj" in data else data
+
+
+def count_pages(f: BinaryIO, xref_offset: int, root: int) -> Optional[int]:
+    catalog = load_object(f, xref_offset, root)
+    pages = re.search(rb"/Pages\s+(\d+)\s+\d+\s+R", catalog) if catalog else None
+    if not pages:
+        return None
+    tree = load_object(f, xref_offset, int(pages.group(1)))
+    count = re.search(rb"/Count\s+(\d+)", tree) if tree else None
+    return int(count.group(1)) if count else None
+
+
+def preflight(pdf: Union[str, BinaryIO]) -> PreflightReport:
+    # cheap check of header, trailer and xref without parsing the whole file.
+    # pdf is a filename or a seekable binary file-like object
+    if isinstance(pdf, str):
+        with open(pdf, "rb") as f:
+            return preflight(f)
+
+    report = PreflightReport()
+
+    def reject(code: str, message: str) -> PreflightReport:
+        report.issues.append(PreflightIssue(code, message))
+        return report
+
+    size = pdf.seek(0, os.SEEK_END)
+    if size == 0:
+        return reject("empty", "File is empty")
+
+    header = re.search(rb"%PDF-(\d\.\d)", read_at(pdf, 0, 1024))
+    if not header:
+        return reject("not-pdf", "No PDF header found")
+    report.version = header.group(1).decode()
+
+    # anything may follow %%EOF, so search backwards for the last startxref
+    startxref = find_startxref(pdf, size)
+    tail = read_at(pdf, startxref, 1024) if startxref is not None else b""
+    if b"%%EOF" not in tail:
+        return reject("truncated", "No end of file marker found, file is probably truncated")
+    match = re.match(rb"startxref\s+(\d+)", tail)
+    if not match or int(match.group(1)) >= size:
+        return reject("truncated", "No valid cross-reference offset found, file is probably truncated")
+    xref_offset = int(match.group(1))
+
+    # the catalog is referenced by the trailer of the newest xref section. in
+    # linearized files and incremental updates it may be in an older one.
+    trailers = [trailer for _, trailer in xref_sections(pdf, xref_offset)]
+    if not trailers:
+        return reject("bad-xref", "No cross-reference table found at offset {}".format(xref_offset))
+
+    if any(re.search(rb"/Encrypt\b", trailer) for trailer in trailers):
+        report.encrypted = True
+        reject("encrypted", "File is encrypted")
+    roots = [re.search(rb"/Root\s+(\d+)\s+\d+\s+R", trailer) for trailer in trailers]
+    root = next((r for r in roots if r), None)
+    if not root:
+        return reject("no-root", "No document catalog found in trailer")
+
+    report.page_count = count_pages(pdf, xref_offset, int(root.group(1)))
+    if report.page_count == 0:
+        reject("no-pages", "Document has no pages")
+    return report
+
+
 def validate_infile(pdf: str) -> str:
     infile = os.path.abspath(pdf)
     if not os.path.exists(infile):
-        print("File does not exist: {}".format(infile))
-        sys.exit(1)
+        raise InvalidInput("File does not exist: {}".format(infile))
+
+    # reject unusable files before they are parsed
+    report = preflight(infile)
+    if report.issues:
+        raise InvalidInput(
+            "Unusable PDF file {}: {}".format(infile, "; ".join(issue.message for issue in report.issues))
+        )
     return infile
 
 
@@ -240,13 +728,12 @@ def validate_papersize(paperformat: str | None, unit: str) -> Optional[List[int]
                     ]
                 else:
                     # invalid input
-                    print(
+                    raise InvalidInput(
                         "Unknown paper format: {}. Must be WIDTHxHEIGHT (e.g 4.3x11)"
                         " or one of the supported standard formats: {}".format(
                             paperformat, ", ".join(sorted(paperformats.keys()))
                         )
                     )
-                    sys.exit(1)
 
     return papersize
 
@@ -254,32 +741,89 @@ def validate_papersize(paperformat: str | None, unit: str) -> Optional[List[int]
 def validate_pages_per_sheet(pages_per_sheet: int) -> int:
     # validate nup
     if pages_per_sheet < 2:
-        print("Pages per sheet must be a greater than 1, is {}".format(pages_per_sheet))
-        sys.exit(1)
+        raise InvalidInput("Pages per sheet must be a greater than 1, is {}".format(pages_per_sheet))
     if not math.log2(pages_per_sheet).is_integer():
-        print("Pages per sheet must be a power of 2, is {}".format(pages_per_sheet))
-        sys.exit(1)
+        raise InvalidInput("Pages per sheet must be a power of 2, is {}".format(pages_per_sheet))
 
     return pages_per_sheet
 
 
+def validate_cost_model(cost: str) -> CostModel:
+    # cost is a comma separated list of KEY=VALUE pairs, e.g. "blank=1,sheet=0.5"
+    keys = {"blank": "blank_page", "sheet": "sheet", "signature": "signature", "min": "min_length", "max": "max_length"}
+    values: Dict[str, Any] = {}
+    for item in cost.split(","):
+        key, _, value = item.partition("=")
+        key = key.strip().lower()
+        if key not in keys:
+            raise InvalidInput("Unknown cost: {}. Must be one of {}".format(key, ", ".join(keys.keys())))
+        try:
+            values[keys[key]] = int(value) if key in ("min", "max") else float(value)
+        except ValueError:
+            raise InvalidInput("Invalid value for cost {}: {}".format(key, value))
+        if values[keys[key]] < 0:
+            raise InvalidInput("Cost {} must not be negative, is {}".format(key, value))
+
+    cost_model = CostModel(**values)
+    # signature lengths are multiples of 4, so the range must contain one
+    if shortest_signature_length(cost_model.min_length) > cost_model.max_length:
+        raise InvalidInput("Invalid signature length range: {}-{}".format(cost_model.min_length, cost_model.max_length))
+    return cost_model
+
+
+def validate_linearize(linearize: bool) -> bool:
+    if linearize and pikepdf is None:
+        raise InvalidInput(LINEARIZE_MISSING)
+    return linearize
+
+
+def validate_copies(copies: int) -> int:
+    if copies < 1:
+        raise InvalidInput("Number of copies must be greater than 0, is {}".format(copies))
+    return copies
+
+
+def validate_signatures(signatures: str) -> List[int]:
+    # signatures is a comma separated list of 1-based numbers and ranges, e.g. "3,7-9"
+    selected = set()
+    for item in signatures.split(","):
+        match = re.match(r"^\s*([0-9]+)\s*(?:-\s*([0-9]+)\s*)?$", item)
+        if not match or int(match.group(1)) < 1 or int(match.group(2) or match.group(1)) < int(match.group(1)):
+            raise InvalidInput(
+                "Invalid signature selection: {}. Must be list of numbers and ranges, e.g. 3,7-9".format(item)
+            )
+        selected.update(range(int(match.group(1)), int(match.group(2) or match.group(1)) + 1))
+    return sorted(selected)
+
+
 def validate_signature_length(signature_length: int) -> int:
     # validate signature_length argument
     if signature_length > 0 and signature_length % 4:
-        print("Signature length must be multiple of 4, is {}".format(signature_length))
-        sys.exit(1)
+        raise InvalidInput("Signature length must be multiple of 4, is {}".format(signature_length))
     return signature_length
 
 
-def impose_and_merge(
+def impose_signatures(
     inpages: List,
     signature_length: int,
     pages_per_sheet: int,
     output_size: Optional[List[int]],
     binding: str,
-) -> List:
-    sheets = []
-    for signature in cut_in_signatures(inpages, signature_length):
+    progress: Optional[Progress] = None,
+    cancel: Optional[Event] = None,
+    signatures: Optional[Collection[int]] = None,
+) -> Iterator[Tuple[int, List]]:
+    # yield 1-based signature number and sheets of each signature as soon as it
+    # is imposed. signatures optionally selects signature numbers to impose.
+    # pages of other signatures are skipped and their content is never loaded.
+    signature_count = math.ceil(len(inpages) / signature_length)
+    total = signature_count if signatures is None else len(signatures)
+    done = 0
+    report_progress(progress, cancel, "impose", done, total)
+    for idx, signature in enumerate(cut_in_signatures(inpages, signature_length)):
+        if signatures is not None and idx + 1 not in signatures:
+            continue
+
         # reverse second half of signature to simplify imposition
         signature[len(signature) // 2 :] = list(reversed(signature[len(signature) // 2 :]))
 
@@ -293,13 +837,38 @@ def impose_and_merge(
         # impose each signature
         signature = impose(signature, pages_per_sheet, binding)
 
-        # extend sheets
-        sheets.extend(signature)
+        done += 1
+        report_progress(progress, cancel, "impose", done, total)
+        yield idx + 1, signature
+
 
+def impose_and_merge(
+    inpages: List,
+    signature_length: int,
+    pages_per_sheet: int,
+    output_size: Optional[List[int]],
+    binding: str,
+    progress: Optional[Progress] = None,
+    cancel: Optional[Event] = None,
+    signatures: Optional[Collection[int]] = None,
+) -> List:
+    sheets = []
+    for _, signature in impose_signatures(
+        inpages, signature_length, pages_per_sheet, output_size, binding, progress, cancel, signatures
+    ):
+        sheets.extend(signature)
     return sheets
 
 
 def add_divider(sheets: List, signature_length: int) -> List:
+    # deprecated, inserts dividers every signature_length // 2 sheets, which
+    # only matches signatures with 2 pages per sheet. the command line tool
+    # adds dividers per signature in cli.impose_signature_sheets.
+    warnings.warn(
+        "add_divider is deprecated, divider pages are added per signature by cli.impose_signature_sheets",
+        DeprecationWarning,
+        stacklevel=2,
+    )
     s = list(sheets)
     divider = create_blank_copy(sheets[0])
     for i in range(signature_length // 2, len(sheets), signature_length // 2):
@@ -308,6 +877,42 @@ def add_divider(sheets: List, signature_length: int) -> List:
     return s
 
 
+def copy_sheets(sheets: List, copies: int, collate: bool = True) -> List:
+    # repeat sheets for printers without copy count. copies only duplicate the
+    # page objects, contents and resources are shared with the original sheets
+    if collate:
+        groups = [sheets]
+    else:
+        # keep front- and backside of each sheet together
+        groups = [sheets[i : i + 2] for i in range(0, len(sheets), 2)]
+
+    # share resources by reference instead of repeating them in every copy
+    for sheet in sheets:
+        if sheet.Resources is not None:
+            sheet.Resources.indirect = True
+
+    s = []
+    for group in groups:
+        s.extend(group)
+        for _ in range(copies - 1):
+            s.extend(IndirectPdfDict(sheet) for sheet in group)
+    return s
+
+
+def fingerprint_page(page: PdfDict, hasher: Optional[ContentHasher] = None) -> str:
+    # return hash of everything that ends up on an imposed sheet. the hash
+    # depends on content only, not on object numbers, so it survives saving
+    # the document again. hasher caches hashes of indirect objects like shared
+    # fonts and should be reused for all pages.
+    hasher = ContentHasher() if hasher is None else hasher
+    inheritable = page.inheritable
+    digest = hashlib.sha1()
+    for name in ("MediaBox", "CropBox", "Rotate", "Resources", "Contents"):
+        digest.update(name.encode("ascii"))
+        digest.update(hasher.key(getattr(inheritable, name)).encode("ascii"))
+    return digest.hexdigest()
+
+
 def outfile(outfolder: str, infile: str) -> str:
     return os.path.join(outfolder, "booklet." + os.path.basename(infile))
 
@@ -319,11 +924,68 @@ def create_outfile(infile: str, outfolder: str) -> str:
     return outfile(outfolder, infile)
 
 
-def save_pdf(infile: str, outpages: List[PdfDict], outdir: str) -> None:
-    trailer = PdfReader(infile)
+def save_pdf(
+    infile: str,
+    outpages: List[PdfDict],
+    outdir: str,
+    progress: Optional[Progress] = None,
+    cancel: Optional[Event] = None,
+    info: Optional[PdfDict] = None,
+    linearize: bool = False,
+) -> None:
+    # reuse info of an already parsed infile instead of parsing it again
+    if info is None:
+        info = PdfReader(infile).Info
     outfn = create_outfile(infile, outdir)
-    writer = PdfWriter()
-    writer.addpages(outpages)
-    writer.trailer.Info = trailer.Info
-    writer.trailer.Info.Producer = "https://github.com/sgelb/impositioner"
-    writer.write(outfn)
+
+    # write to a temporary file first, so that a cancelled or failed job never
+    # leaves a truncated pdf behind
+    tmpfn = outfn + ".part"
+    try:
+        write_pdf(outpages, tmpfn, info, progress, cancel, linearize)
+        # a job cancelled after its last step must not replace the output
+        check_cancelled(cancel, "save")
+        os.replace(tmpfn, outfn)
+    except BaseException:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+        raise
+
+
+def write_pdf(
+    outpages: List[PdfDict],
+    out: Union[str, BinaryIO],
+    info: Optional[PdfDict],
+    progress: Optional[Progress] = None,
+    cancel: Optional[Event] = None,
+    linearize: bool = False,
+) -> None:
+    # out is either a filename or a binary file-like object
+    if linearize and pikepdf is None:
+        raise RuntimeError(LINEARIZE_MISSING)
+
+    if linearize:
+        # StreamWriter can't linearize, so let qpdf reorder the written pdf by
+        # page and add the first page hint tables
+        buffer = io.BytesIO()
+        write_pdf(outpages, buffer, info, progress, cancel)
+        buffer.seek(0)
+        report_progress(progress, cancel, "linearize", 0, 1)
+        with pikepdf.open(buffer) as pdf:
+            pdf.save(out, linearize=True)
+        report_progress(progress, cancel, "linearize", 1, 1)
+        return
+    if isinstance(out, str):
+        with open(out, "wb") as f:
+            return write_pdf(outpages, f, info, progress, cancel)
+
+    # same writer as used for checkpointed output, so both yield the same bytes.
+    # it serializes each page as soon as it is added, so progress follows the
+    # actual writing.
+    writer = StreamWriter(out)
+    writer.start()
+    report_progress(progress, cancel, "save", 0, len(outpages))
+    for idx, page in enumerate(outpages):
+        writer.add_page(page)
+        report_progress(progress, cancel, "save", idx + 1, len(outpages))
+    writer.close(info)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+# Copyright (C) sgelb 2019
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>
+
+"""
+PDF writer, that writes imposed sheets as soon as they are added
+
+CheckpointWriter records every finished signature in a checkpoint file next
+to the output. An interrupted job can be resumed from the last finished
+signature and yields the same bytes as an uninterrupted one.
+"""
+
+import hashlib
+import json
+import os
+from collections import deque
+from typing import Any, BinaryIO, Deque, Dict, List, Optional, Tuple
+
+from pdfrw import IndirectPdfDict, PdfDict, PdfObject
+from pdfrw.pdfwriter import user_fmt
+from pdfrw.py23_diffs import convert_store
+
+HEADER = "%PDF-1.3\n%\xe2\xe3\xcf\xd3\n"
+
+# object numbers of the objects written on close
+PAGES, CATALOG, INFO = 1, 2, 3
+
+
+def is_indirect(obj: Any) -> bool:
+    # same rules as pdfrw: streams are always indirect objects
+    if isinstance(obj, PdfDict):
+        return bool(obj.indirect) or obj.stream is not None
+    return bool(getattr(obj, "indirect", False))
+
+
+def format_scalar(obj: Any) -> str:
+    # an object with an indirect attribute knows how to represent itself
+    if hasattr(obj, "indirect"):
+        return str(getattr(obj, "encoded", None) or obj)
+    return user_fmt(obj)
+
+
+class ContentHasher:
+    # hashes objects by content, where references to other indirect objects
+    # are replaced by their hashes. the hash does not depend on object numbers
+    # or python identity, so it survives parsing and saving a document again.
+
+    def __init__(self) -> None:
+        # key cache by object id. cached objects are kept alive, so that their
+        # id can't be reused by another object
+        self._keys: Dict[int, Tuple[str, Any]] = {}
+        self._stack: List[int] = []
+
+    def clear(self) -> None:
+        self._keys.clear()
+
+    def key(self, obj: Any) -> str:
+        return self._key(obj)[0]
+
+    def _key(self, obj: Any) -> Tuple[str, int]:
+        # return content hash of obj and the lowest stack depth referenced by
+        # a reference cycle inside obj
+        objid = id(obj)
+        cached = self._keys.get(objid)
+        if cached is not None:
+            return cached[0], len(self._stack)
+        if objid in self._stack:
+            depth = self._stack.index(objid)
+            return "^{}".format(len(self._stack) - depth), depth
+
+        depth = len(self._stack)
+        self._stack.append(objid)
+        digest = hashlib.sha1()
+        lowest = self._hash(obj, digest)
+        self._stack.pop()
+        key = digest.hexdigest()
+        # keys of objects inside a cycle depend on where the cycle is entered
+        if lowest >= depth:
+            self._keys[objid] = key, obj
+        return key, lowest
+
+    def _hash(self, obj: Any, digest: Any) -> int:
+        lowest = len(self._stack)
+        if isinstance(obj, dict):
+            digest.update(b"<<")
+            for k, v in sorted((getattr(k, "encoded", None) or k, v) for k, v in obj.items() if v is not None):
+                digest.update(convert_store(k))
+                lowest = min(lowest, self._hash_value(v, digest))
+            digest.update(b">>")
+            if isinstance(obj, PdfDict) and obj.stream is not None:
+                digest.update(b"stream")
+                digest.update(convert_store(obj.stream))
+        elif isinstance(obj, (list, tuple)):
+            digest.update(b"[")
+            for v in obj:
+                lowest = min(lowest, self._hash_value(v, digest))
+            digest.update(b"]")
+        else:
+            digest.update(convert_store(format_scalar(obj)))
+        return lowest
+
+    def _hash_value(self, obj: Any, digest: Any) -> int:
+        digest.update(b" ")
+        if not is_indirect(obj):
+            return self._hash(obj, digest)
+        key, lowest = self._key(obj)
+        digest.update(b"@" + key.encode("ascii"))
+        return lowest
+
+
+class StreamWriter:
+    def __init__(self, f: Optional[BinaryIO] = None):
+        self.f = f
+        self._reset()
+
+    def _reset(self) -> None:
+        # objects are deduplicated by a key derived from their content, not by
+        # their python identity, so that a resumed job numbers them the same
+        self.offset = 0
+        # offset of previous xref section when writing an incremental update
+        self.prev: Optional[int] = None
+        self.xref: Optional[int] = None
+        self.objects: Dict[str, int] = {}
+        self.offsets: Dict[int, int] = {}
+        self.pages: List[int] = []
+        self.next_objnum = INFO + 1
+        self.signature = 0
+
+        self._hasher = ContentHasher()
+        self._pending: Deque[Tuple[int, Any]] = deque()
+        self._new: List[Tuple[str, int]] = []
+        self._written: List[Tuple[int, int]] = []
+
+    def start(self) -> None:
+        self._write(HEADER)
+
+    def start_update(self, objects: Dict[str, int], next_objnum: int, xref: int, offset: int) -> None:
+        # append an incremental update to a file written by a StreamWriter,
+        # which ends at offset and has its xref at xref. objects maps content
+        # keys of its objects to their numbers, so that they are referenced
+        # instead of written again. pages have to be added again, either with
+        # add_page or by number to pages.
+        self.objects = dict(objects)
+        self.next_objnum = next_objnum
+        self.prev = xref
+        self.offset = offset
+
+    def add_page(self, sheet: PdfDict) -> None:
+        inheritable = sheet.inheritable
+        page = IndirectPdfDict(
+            sheet,
+            Resources=inheritable.Resources,
+            MediaBox=inheritable.MediaBox,
+            CropBox=inheritable.CropBox,
+            Rotate=inheritable.Rotate,
+            Parent=PdfObject("{} 0 R".format(PAGES)),
+        )
+        # pages are never shared, even if two sheets look the same
+        objnum = self._allocate()
+        self.pages.append(objnum)
+        self._pending.append((objnum, page))
+        self._write_pending()
+
+    def add_content_page(self, mediabox: List[float], content: str, resources: Any, rotate: int = 0) -> None:
+        # write a page from its content stream as plain strings, which is much
+        # faster than building pdfrw objects for every page. resources are
+        # deduplicated like any other object.
+        contents = self._allocate()
+        self._write_object(contents, "<</Length {}>>\nstream\n{}\nendstream".format(len(content), content))
+        objnum = self._allocate()
+        self._write_object(
+            objnum,
+            "<</Contents {} 0 R /MediaBox [{}] /Parent {} 0 R /Resources {} /Rotate {} /Type /Page>>".format(
+                contents, " ".join(map(format_scalar, mediabox)), PAGES, self._value(resources), rotate
+            ),
+        )
+        self.pages.append(objnum)
+        self._write_pending()
+
+    def close(self, info: Optional[PdfDict] = None) -> None:
+        kids = " ".join("{} 0 R".format(objnum) for objnum in self.pages)
+        self._write_object(PAGES, "<</Count {} /Kids [{}] /Type /Pages>>".format(len(self.pages), kids))
+        self._write_object(CATALOG, "<</Pages {} 0 R /Type /Catalog>>".format(PAGES))
+        info = info if info is not None else PdfDict()
+        info.Producer = "https://github.com/sgelb/impositioner"
+        self._write_object(INFO, self._format(info))
+        self._write_pending()
+
+        self.xref = self.offset
+        if self.prev is None:
+            self._write("xref\n0 {}\n".format(self.next_objnum))
+            self._write("{:010d} {:05d} f\r\n".format(0, 65535))
+            for objnum in range(1, self.next_objnum):
+                self._write("{:010d} {:05d} n\r\n".format(self.offsets[objnum], 0))
+            prev = ""
+        else:
+            # an update only lists its own objects, in subsections of
+            # consecutive numbers
+            self._write("xref\n")
+            objnums = sorted(self.offsets)
+            start = 0
+            for end in range(1, len(objnums) + 1):
+                if end == len(objnums) or objnums[end] != objnums[end - 1] + 1:
+                    self._write("{} {}\n".format(objnums[start], end - start))
+                    for objnum in objnums[start:end]:
+                        self._write("{:010d} {:05d} n\r\n".format(self.offsets[objnum], 0))
+                    start = end
+            prev = " /Prev {}".format(self.prev)
+        self._write(
+            "trailer\n\n<</Info {} 0 R{} /Root {} 0 R /Size {}>>\nstartxref\n{}\n%%EOF\n".format(
+                INFO, prev, CATALOG, self.next_objnum, self.xref
+            )
+        )
+
+    def _allocate(self) -> int:
+        objnum = self.next_objnum
+        self.next_objnum += 1
+        return objnum
+
+    def _write(self, s: str) -> None:
+        data = convert_store(s)
+        self.f.write(data)
+        self.offset += len(data)
+
+    def _write_object(self, objnum: int, body: str) -> None:
+        self.offsets[objnum] = self.offset
+        self._written.append((objnum, self.offset))
+        self._write("{} 0 obj\n{}\nendobj\n".format(objnum, body))
+
+    def _write_pending(self) -> None:
+        while self._pending:
+            objnum, obj = self._pending.popleft()
+            self._write_object(objnum, self._format(obj))
+
+    def _format(self, obj: Any) -> str:
+        if isinstance(obj, PdfDict):
+            pairs = sorted((getattr(k, "encoded", None) or k, v) for k, v in obj.iteritems())
+            result = "<<{}>>".format(" ".join("{} {}".format(k, self._value(v)) for k, v in pairs))
+            if obj.stream is not None:
+                result = "{}\nstream\n{}\nendstream".format(result, obj.stream)
+            return result
+        if isinstance(obj, (list, tuple)):
+            return "[{}]".format(" ".join(self._value(x) for x in obj))
+        if isinstance(obj, dict):
+            return self._format(PdfDict(obj))
+        return format_scalar(obj)
+
+    def _value(self, obj: Any) -> str:
+        # format direct objects in place, reference indirect ones
+        if not is_indirect(obj):
+            return self._format(obj)
+        key = self._hasher.key(obj)
+        objnum = self.objects.get(key)
+        if objnum is None:
+            objnum = self._allocate()
+            self.objects[key] = objnum
+            self._new.append((key, objnum))
+            self._pending.append((objnum, obj))
+        return "{} 0 R".format(objnum)
+
+
+class CheckpointWriter(StreamWriter):
+    def __init__(self, fname: str):
+        super().__init__()
+        self.fname = fname
+        self.checkpoint = fname + ".checkpoint"
+
+    def open(self, job: str = "") -> int:
+        # job identifies input and settings. a checkpoint of another job is
+        # discarded. returns number of the last finished signature.
+        if self._load_checkpoint(job):
+            # drop anything written after the last finished signature
+            with open(self.checkpoint, "r+") as c:
+                c.truncate(self._checkpoint_size)
+            self.f = open(self.fname, "r+b")
+            self.f.truncate(self.offset)
+            self.f.seek(self.offset)
+            return self.signature
+
+        self._reset()
+        self.f = open(self.fname, "wb")
+        self.start()
+        with open(self.checkpoint, "w") as c:
+            c.write(json.dumps({"job": job, "offset": self.offset}) + "\n")
+        return 0
+
+    def add_signature(self, signature: int, sheets: List[PdfDict]) -> None:
+        for sheet in sheets:
+            self.add_page(sheet)
+
+        # make sure all objects are on disk before they are recorded
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        record = {
+            "signature": signature,
+            "offset": self.offset,
+            "pages": self.pages[-len(sheets) :] if sheets else [],
+            "objects": self._new,
+            "offsets": self._written,
+        }
+        with open(self.checkpoint, "a") as c:
+            c.write(json.dumps(record) + "\n")
+            c.flush()
+            os.fsync(c.fileno())
+        self._new = []
+        self._written = []
+        self._hasher.clear()
+        self.signature = signature
+
+    def close(self, info: Optional[PdfDict] = None) -> None:
+        super().close(info)
+        self.f.close()
+        os.remove(self.checkpoint)
+
+    def abort(self) -> None:
+        # keep partial output and checkpoint, so the job can be resumed
+        if self.f is not None:
+            self.f.close()
+
+    def _load_checkpoint(self, job: str) -> bool:
+        if not (os.path.exists(self.checkpoint) and os.path.exists(self.fname)):
+            return False
+        with open(self.checkpoint) as c:
+            lines = c.read().split("\n")
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return False
+        if header.get("job") != job:
+            return False
+
+        self.offset = header["offset"]
+        self._checkpoint_size = sum(len(line) + 1 for line in lines[:-1])
+        # the last line is empty or, after a crash, an incomplete record
+        for line in lines[1:-1]:
+            record = json.loads(line)
+            for key, objnum in record["objects"]:
+                self.objects[key] = objnum
+            for objnum, offset in record["offsets"]:
+                self.offsets[objnum] = offset
+            self.pages.extend(record["pages"])
+            self.offset = record["offset"]
+            self.signature = record["signature"]
+
+        if os.path.getsize(self.fname) < self.offset:
+            return False
+        self.next_objnum = max(self.offsets, default=INFO) + 1
+        return True
@@ -3,5 +3,7 @@ import sys
 
 sys.path.insert(0, os.path.abspath(".."))
 
+import impositioner.aio as aio
 import impositioner.cli as cli
 import impositioner.core as core
+import impositioner.streamwriter as streamwriter
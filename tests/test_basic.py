@@ -1,9 +1,17 @@
+import io
 import os
 import unittest
+from tempfile import TemporaryDirectory
+from threading import Event
 
-from pdfrw import PageMerge, PdfReader
+from pdfrw import PageMerge, PdfDict, PdfName, PdfReader
 
-from .context import core
+from .context import core, streamwriter
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
 
 # class test_cli(unittest.TestCase):
 
@@ -47,6 +55,42 @@ class test_core(unittest.TestCase):
         self.assertEqual(core.calculate_signature_length(61), 32)
         self.assertEqual(core.calculate_signature_length(65), 36)
 
+    def test_plan_signatures(self):
+        # default cost model matches calculate_signature_length for 2 pages per sheet
+        for page_count in range(1, 200):
+            plan = core.plan_signatures(page_count, 2, core.CostModel())[0]
+            self.assertEqual(plan.signature_length, core.calculate_signature_length(page_count))
+
+        # with 8 pages per sheet, signatures of 20 pages would need 12 blanks each
+        plan = core.plan_signatures(64, 8, core.CostModel())[0]
+        self.assertEqual((plan.signature_length, plan.blank_pages, plan.sheets), (32, 0, 4))
+
+        plan = core.evaluate_plan(37, 2, 20, core.CostModel(blank_page=1, sheet=2, signature=10))
+        self.assertEqual((plan.signature_count, plan.blank_pages, plan.sheets, plan.cost), (2, 3, 10, 43))
+
+        cost_model = core.CostModel(blank_page=0, signature=1, min_length=4, max_length=200)
+        self.assertEqual(core.plan_signatures(150, 2, cost_model)[0].signature_length, 152)
+
+    def test_validate_cost_model(self):
+        self.assertEqual(core.validate_cost_model("blank=2,min=8"), core.CostModel(blank_page=2, min_length=8))
+        self.assertEqual(
+            core.validate_cost_model("sheet=0.5, signature=3,max=40"),
+            core.CostModel(sheet=0.5, signature=3, max_length=40),
+        )
+        with self.assertRaises(SystemExit):
+            core.validate_cost_model("paper=1")
+        with self.assertRaises(SystemExit):
+            core.validate_cost_model("blank=a")
+        with self.assertRaises(SystemExit):
+            core.validate_cost_model("blank=-1")
+        with self.assertRaises(SystemExit):
+            core.validate_cost_model("min=40,max=20")
+        with self.assertRaises(SystemExit):
+            core.validate_cost_model("min=37,max=38")
+        with self.assertRaises(SystemExit):
+            core.validate_cost_model("max=3")
+        self.assertEqual(core.validate_cost_model("min=37,max=40").max_length, 40)
+
     def test_cut_in_signatures(self):
         self.assertEqual(list(core.cut_in_signatures([1, 2, 3, 4], 2)), [[1, 2], [3, 4]])
         self.assertEqual(list(core.cut_in_signatures([1, 2, 3, 4], 4)), [[1, 2, 3, 4]])
@@ -59,6 +103,27 @@ class test_core(unittest.TestCase):
         self.assertEqual(core.calculate_scaled_sub_page_size(2, core.paperformats["a4"]), [421, 595])
         self.assertEqual(core.calculate_scaled_sub_page_size(8, core.paperformats["a4"]), [298, 210])
 
+    def test_calculate_grid(self):
+        a4 = core.paperformats["a4"]
+        self.assertEqual(core.calculate_grid(2, a4, False), ([842, 595], [421, 595], 2, 1))
+        self.assertEqual(core.calculate_grid(2, a4, True), ([595, 842], [595, 421], 1, 2))
+        self.assertEqual(core.calculate_grid(4, a4, False), ([595, 842], [298, 421], 2, 2))
+        self.assertEqual(core.calculate_grid(8, a4, True), ([595, 842], [298, 210], 2, 4))
+        self.assertEqual(core.calculate_grid(16, a4, False), ([595, 842], [149, 210], 4, 4))
+
+    def test_step_and_repeat(self):
+        sheets = core.step_and_repeat(self.portrait_pdf, 4, core.paperformats["a4"])
+        self.assertEqual(len(sheets), len(self.portrait_pdf))
+        self.assertEqual(sheets[0].MediaBox, [0, 0, 595, 842])
+        # same content stream for all sheets, one xobject per page
+        self.assertTrue(all(sheet.Contents is sheets[0].Contents for sheet in sheets))
+        self.assertEqual(sheets[0].Contents.stream.count("/P Do"), 4)
+        self.assertEqual(len(set(id(sheet.Resources.XObject.P) for sheet in sheets)), len(sheets))
+
+        sheets = core.step_and_repeat(self.landscape_pdf, 8, core.paperformats["a4"])
+        self.assertEqual(sheets[0].MediaBox, [0, 0, 595, 842])
+        self.assertEqual(sheets[0].Contents.stream.split("\n")[-1], "q 0.5 0 0 0.5 298 630 cm /P Do Q")
+
     def test_add_blanks(self):
         with self.assertRaises(ZeroDivisionError):
             core.add_blanks(self.portrait_pdf, 0)
@@ -142,6 +207,45 @@ class test_core(unittest.TestCase):
     def test_validate_infile(self):
         with self.assertRaises(SystemExit):
             core.validate_infile("not_exisiting.pdf")
+        with self.assertRaises(SystemExit):
+            core.validate_infile("tests/test_basic.py")
+
+    def test_preflight(self):
+        for fn in ("tests/a5_portrait_20.pdf", "tests/a5_landscape_20.pdf"):
+            self.assertEqual(core.preflight(fn), core.PreflightReport(version="1.3", page_count=20))
+
+        with open("tests/a5_portrait_20.pdf", "rb") as f:
+            data = f.read()
+
+        def codes(data):
+            return [issue.code for issue in core.preflight(io.BytesIO(data)).issues]
+
+        self.assertEqual(codes(b""), ["empty"])
+        self.assertEqual(codes(b"<html></html>"), ["not-pdf"])
+        self.assertEqual(codes(data[: len(data) // 2]), ["truncated"])
+        self.assertEqual(codes(data.replace(b"startxref\r\n10008", b"startxref\r\n99999")), ["truncated"])
+        self.assertEqual(codes(data.replace(b"startxref\r\n10008", b"startxref\r\n10000")), ["bad-xref"])
+        self.assertEqual(codes(data.replace(b"/Info 25 0 R", b"/Encrypt 9 0 R")), ["encrypted"])
+        self.assertEqual(codes(data.replace(b"/Root 24 0 R", b"")), ["no-root"])
+        self.assertEqual(codes(data.replace(b"/Count 20", b"/Count  0")), ["no-pages"])
+
+        # anything may follow %%EOF
+        self.assertEqual(core.preflight(io.BytesIO(data + b"\0" * 5000)).page_count, 20)
+        # like linearized files, last trailer without /Root and startxref to an earlier xref section
+        linearized = data + b"trailer\n<</Size 27>>\nstartxref\n10008\n%%EOF\n"
+        self.assertEqual(core.preflight(io.BytesIO(linearized)).page_count, 20)
+        # startxref is only searched for near the end of the file
+        self.assertEqual(codes(data + b"\0" * core.PREFLIGHT_TAIL), ["truncated"])
+
+    @unittest.skipIf(pikepdf is None, "pikepdf not installed")
+    def test_preflight_object_streams(self):
+        # catalog and page tree are compressed in object streams, found
+        # through xref streams with png predictors
+        for options in ({}, {"compress_streams": False}, {"qdf": True}):
+            out = io.BytesIO()
+            with pikepdf.open("tests/a5_portrait_20.pdf") as pdf:
+                pdf.save(out, object_stream_mode=pikepdf.ObjectStreamMode.generate, **options)
+            self.assertEqual(core.preflight(out), core.PreflightReport(version="1.5", page_count=20))
 
     def test_validate_papersize(self):
         self.assertEqual(core.validate_papersize(None, "mm"), None)
@@ -201,7 +305,8 @@ class test_core(unittest.TestCase):
         blank_page = core.create_blank_copy(self.portrait_pdf[0])
         self.assertNotEqual(self.portrait_pdf[10], blank_page)
 
-        divided_pages = core.add_divider(self.portrait_pdf, 10)
+        with self.assertWarns(DeprecationWarning):
+            divided_pages = core.add_divider(self.portrait_pdf, 10)
 
         self.assertEqual(divided_pages[7], self.portrait_pdf[5])
         self.assertEqual(divided_pages[14], self.portrait_pdf[10])
@@ -211,6 +316,109 @@ class test_core(unittest.TestCase):
         self.assertEqual(divided_pages[10], blank_page)
         self.assertEqual(divided_pages[11], blank_page)
 
+    def test_add_content_page(self):
+        out = io.BytesIO()
+        writer = streamwriter.StreamWriter(out)
+        writer.start()
+        font = PdfDict(indirect=True, Type=PdfName.Font, Subtype=PdfName.Type1, BaseFont=PdfName.Helvetica)
+        for number in range(3):
+            resources = PdfDict(Font=PdfDict(F=font))
+            writer.add_content_page([0, 0, 420, 595], "BT /F 10 Tf ({}) Tj ET".format(number), resources, 90)
+        writer.close()
+
+        pages = PdfReader(fdata=out.getvalue().decode("latin-1")).pages
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(pages[2].MediaBox, ["0", "0", "420", "595"])
+        self.assertEqual(pages[2].Rotate, "90")
+        self.assertEqual(pages[2].Contents.stream, "BT /F 10 Tf (2) Tj ET")
+        # equal resources are written once
+        self.assertEqual(out.getvalue().count(b"/BaseFont /Helvetica"), 1)
+
+    def test_impose_selected_signatures(self):
+        pages = list(self.portrait_pdf) + [core.create_blank_copy(self.portrait_pdf[0])] * 4
+        sheets = core.impose_and_merge(list(pages), 8, 2, None, "left")
+        selected = core.impose_and_merge(list(pages), 8, 2, None, "left", signatures=[1, 3])
+        self.assertEqual(len(sheets), 12)
+        self.assertEqual(len(selected), 8)
+        self.assertEqual([s.MediaBox for s in selected], [s.MediaBox for s in sheets[:4] + sheets[8:]])
+
+    def test_validate_signatures(self):
+        self.assertEqual(core.validate_signatures("3"), [3])
+        self.assertEqual(core.validate_signatures("3,7-9"), [3, 7, 8, 9])
+        self.assertEqual(core.validate_signatures("9, 2 - 3,3"), [2, 3, 9])
+        with self.assertRaises(SystemExit):
+            core.validate_signatures("0")
+        with self.assertRaises(SystemExit):
+            core.validate_signatures("5-3")
+        with self.assertRaises(SystemExit):
+            core.validate_signatures("3,")
+        with self.assertRaises(SystemExit):
+            core.validate_signatures("a-b")
+
+    def test_progress(self):
+        events = []
+        core.impose_and_merge(list(self.portrait_pdf), 8, 2, None, "left", lambda *event: events.append(event))
+        self.assertEqual(events, [("impose", i, 3) for i in range(4)])
+
+        events = []
+        core.resize(self.portrait_pdf, [10, 10], lambda *event: events.append(event))
+        self.assertEqual(events[-1], ("resize", 20, 20))
+
+        # pages are written when their progress is reported, not afterwards
+        out = io.BytesIO()
+        offsets = []
+        core.write_pdf(self.portrait_pdf, out, None, lambda *event: offsets.append(out.tell()))
+        self.assertEqual(len(offsets), 21)
+        self.assertTrue(all(a < b for a, b in zip(offsets, offsets[1:])))
+        # only page tree, catalog, info and xref are written after the last page
+        self.assertTrue(out.getvalue()[offsets[-1] :].startswith(b"1 0 obj\n<</Count 20"))
+
+    def test_cancel(self):
+        cancel = Event()
+        cancel.set()
+        with self.assertRaises(core.Cancelled):
+            core.impose_and_merge(list(self.portrait_pdf), 8, 2, None, "left", None, cancel)
+
+        infile = os.path.abspath("tests/a5_portrait_20.pdf")
+        with TemporaryDirectory() as d:
+            with self.assertRaises(core.Cancelled):
+                core.save_pdf(infile, self.portrait_pdf, d, None, cancel)
+            self.assertEqual(os.listdir(d), [])
+
+        # cancelled after the last page was written
+        cancel = Event()
+
+        def progress(stage, done, total):
+            if done == total:
+                cancel.set()
+
+        with TemporaryDirectory() as d:
+            with self.assertRaises(core.Cancelled):
+                core.save_pdf(infile, self.portrait_pdf, d, progress, cancel)
+            self.assertEqual(os.listdir(d), [])
+
+    def test_copy_sheets(self):
+        sheets = core.impose_and_merge(list(self.portrait_pdf), 8, 2, None, "left")[:4]
+
+        collated = core.copy_sheets(sheets, 3)
+        self.assertEqual(len(collated), 12)
+        self.assertEqual(collated[:4], sheets)
+        self.assertEqual([s.Contents for s in collated[4:8]], [s.Contents for s in sheets])
+
+        uncollated = core.copy_sheets(sheets, 3, collate=False)
+        self.assertEqual([s.Contents for s in uncollated[:6]], [s.Contents for s in sheets[:2]] * 3)
+        self.assertEqual(len(set(id(s) for s in uncollated)), 12)
+        for i, sheet in enumerate(uncollated):
+            self.assertIs(sheet.Resources, sheets[i // 6 * 2 + i % 2].Resources)
+
+        self.assertEqual(core.copy_sheets(sheets, 1), sheets)
+
+    def test_validate_copies(self):
+        self.assertEqual(core.validate_copies(1), 1)
+        self.assertEqual(core.validate_copies(200), 200)
+        with self.assertRaises(SystemExit):
+            core.validate_copies(0)
+
     # def test_impose(self):
     #     pass
 
@@ -1,10 +1,24 @@
+import asyncio
 import hashlib
+import io
+import json
 import os
 import shutil
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
 from tempfile import TemporaryDirectory
+from threading import Event
+from unittest import mock
 
-from .context import cli, core
+from pdfrw import PdfReader
+
+from .context import aio, cli, core
+
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
 
 
 def md5sum(filename, blocksize=65536):
@@ -18,8 +32,8 @@ def md5sum(filename, blocksize=65536):
 class test_pdf(unittest.TestCase):
     def setUp(self):
         self.testfiles = {
-            os.path.abspath("tests/a5_portrait_20.pdf"): "930eef35aed350e7082edc9be07c1331",
-            os.path.abspath("tests/a5_landscape_20.pdf"): "0e4942d591ac854fe37b18e65fef4af9",
+            os.path.abspath("tests/a5_portrait_20.pdf"): "e24feb9ed836791c4e39feb11b298851",
+            os.path.abspath("tests/a5_landscape_20.pdf"): "9260544b922022290360ed8064485aaa",
         }
 
     def tearDown(self):
@@ -34,3 +48,276 @@ class test_pdf(unittest.TestCase):
                 args = cli.Arguments(pdf=testfile, outfolder=d)
                 cli.run(args)
                 self.assertEqual(md5sum(bookletfile), hash)
+
+    @unittest.skipIf(pikepdf is None, "pikepdf not installed")
+    def testLinearized(self):
+        with TemporaryDirectory() as d:
+            for fn in self.testfiles:
+                shutil.copy(fn, d)
+                testfile = os.path.join(d, os.path.basename(fn))
+                cli.run(cli.Arguments(pdf=testfile, outfolder=d, linearize=True))
+                with pikepdf.open(core.outfile(d, fn)) as pdf:
+                    self.assertTrue(pdf.is_linearized)
+                    self.assertTrue(pdf.check_linearization())
+                    self.assertEqual(len(pdf.pages), 10)
+                self.assertEqual(core.preflight(core.outfile(d, fn)).issues, [])
+
+    def testLinearizeWithoutPikepdf(self):
+        fn = next(iter(self.testfiles))
+        with open(fn, "rb") as f:
+            data = f.read()
+        with mock.patch.object(core, "pikepdf", None), TemporaryDirectory() as d:
+            with self.assertRaises(SystemExit):
+                cli.run(cli.Arguments(pdf=fn, outfolder=d, linearize=True))
+            self.assertEqual(os.listdir(d), [])
+            with self.assertRaises(ValueError):
+                asyncio.run(aio.impose(data, cli.Arguments(pdf="", linearize=True)))
+            with self.assertRaises(RuntimeError):
+                core.write_pdf([], io.BytesIO(), None, linearize=True)
+
+    def testCheckpointMatchesDefault(self):
+        with TemporaryDirectory() as d:
+            for fn in self.testfiles:
+                shutil.copy(fn, d)
+                testfile = os.path.join(d, os.path.basename(fn))
+                bookletfile = core.outfile(d, fn)
+                for nup in (2, 4):
+                    args = cli.Arguments(
+                        pdf=testfile, outfolder=d, nup=nup, paperformat="a4", signature_length=8, divider=True
+                    )
+                    cli.run(args)
+                    expected = md5sum(bookletfile)
+                    args.checkpoint = True
+                    cli.run(args)
+                    self.assertEqual(md5sum(bookletfile), expected)
+                    # 3 signatures with dividers in front of the last two
+                    self.assertEqual(len(PdfReader(bookletfile).pages), 3 * 8 // nup + 4)
+
+    def testCheckpointResume(self):
+        with TemporaryDirectory() as d:
+            for fn in self.testfiles:
+                shutil.copy(fn, d)
+                testfile = os.path.join(d, os.path.basename(fn))
+                bookletfile = core.outfile(d, fn)
+                args = cli.Arguments(pdf=testfile, outfolder=d, signature_length=8, checkpoint=True)
+                cli.run(args)
+                expected = md5sum(bookletfile)
+                os.remove(bookletfile)
+
+                # cancel job after first signature
+                cancel = Event()
+
+                def progress(stage, done, total):
+                    if done == 1:
+                        cancel.set()
+
+                reader = PdfReader(testfile)
+                with self.assertRaises(core.Cancelled):
+                    cli.save_checkpointed(testfile, reader.pages, args, reader.Info, progress, cancel)
+                self.assertFalse(os.path.exists(bookletfile))
+
+                # simulate crash while writing next signature
+                with open(bookletfile + ".part", "ab") as f:
+                    f.write(b"99 0 obj\n<</Type")
+                with open(bookletfile + ".part.checkpoint", "a") as f:
+                    f.write('{"signature": 2, "off')
+
+                cli.run(args)
+                self.assertEqual(md5sum(bookletfile), expected)
+                self.assertEqual(
+                    sorted(os.listdir(d)), sorted([os.path.basename(testfile), "booklet." + os.path.basename(testfile)])
+                )
+                os.remove(testfile)
+                os.remove(bookletfile)
+
+    def testStepRepeatConflicts(self):
+        pages = PdfReader(next(iter(self.testfiles))).pages
+        sheets, _ = cli.impose_pages(list(pages), cli.Arguments(pdf="", nup=4, paperformat="a4", step_repeat=True))
+        self.assertEqual(len(sheets), 20)
+        for option in (
+            {"signatures": "2"},
+            {"divider": True},
+            {"signature_length": 8},
+            {"center_subpage": True},
+            {"cost": "blank=1"},
+        ):
+            args = cli.Arguments(pdf="", nup=4, paperformat="a4", step_repeat=True, **option)
+            with self.assertRaises(SystemExit):
+                cli.impose_pages(list(pages), args)
+
+    def testDryRun(self):
+        fn = next(iter(self.testfiles))
+        out = io.StringIO()
+        # the page count comes from preflight, the pdf is not parsed
+        with mock.patch.object(cli, "PdfReader", side_effect=AssertionError), redirect_stdout(out):
+            cli.run(cli.Arguments(pdf=fn, dry_run=True, signature_length=8))
+        result = json.loads(out.getvalue())
+        self.assertEqual(result["page_count"], 20)
+        self.assertEqual(result["plan"]["signature_count"], 3)
+
+    def testCancelMessage(self):
+        for option, message in (
+            ([], "no output written"),
+            (["--checkpoint"], "run again with the same arguments to resume"),
+            (["--incremental"], "previous output kept"),
+        ):
+            out = io.StringIO()
+            argv = ["impositioner", "in.pdf"] + option
+            with mock.patch.object(cli, "run", side_effect=core.Cancelled), mock.patch.object(cli.signal, "signal"):
+                with mock.patch.object(cli.sys, "argv", argv), redirect_stdout(out):
+                    self.assertEqual(cli.main(), 1)
+            self.assertIn(message, out.getvalue())
+
+    def testIncremental(self):
+        with TemporaryDirectory() as d:
+            for fn in self.testfiles:
+                shutil.copy(fn, d)
+                testfile = os.path.join(d, os.path.basename(fn))
+                bookletfile = core.outfile(d, fn)
+                args = cli.Arguments(pdf=testfile, outfolder=d, signature_length=8, divider=True, incremental=True)
+
+                def save(pages=None, cancel=None):
+                    reader = PdfReader(testfile)
+                    return cli.save_incremental(testfile, pages or reader.pages, args, reader.Info, None, cancel)
+
+                def read():
+                    with open(bookletfile, "rb") as f:
+                        return f.read()
+
+                # nothing to reuse on first run, everything on second
+                self.assertEqual(save(), (8, 16, 0))
+                previous = read()
+                self.assertEqual(save(), (8, 16, 3))
+                self.assertEqual(read(), previous)
+
+                # change a page of the second signature. only its divider pages
+                # and sheets are appended, the rest of the output is untouched
+                pages = PdfReader(testfile).pages
+                pages[9] = pages[0]
+
+                # a cancelled run keeps output and manifest
+                cancel = Event()
+                cancel.set()
+                with self.assertRaises(core.Cancelled):
+                    save(pages, cancel)
+                self.assertEqual(read(), previous)
+                self.assertFalse(os.path.exists(bookletfile + ".part"))
+
+                self.assertEqual(save(pages), (8, 16, 2))
+                data = read()
+                self.assertTrue(data.startswith(previous))
+                self.assertEqual(data[len(previous) :].count(b"/Type /Page>>"), 6)
+                self.assertEqual(len(PdfReader(bookletfile).pages), 16)
+                with open(bookletfile, "rb") as f:
+                    self.assertEqual(core.preflight(f).issues, [])
+                if pikepdf is not None:
+                    with pikepdf.open(bookletfile) as pdf:
+                        self.assertEqual(pdf.check_pdf_syntax(), [])
+
+                # once replaced sheets outnumber sheets in use, the output is
+                # written again
+                pages[9] = pages[1]
+                self.assertEqual(save(pages), (8, 16, 0))
+                self.assertFalse(read().startswith(data))
+                self.assertEqual(read().count(b"/Type /Page>>"), 16)
+
+                # output written without manifest is imposed again
+                cli.run(cli.Arguments(pdf=testfile, outfolder=d, signature_length=8, divider=True))
+                self.assertEqual(save(), (8, 16, 0))
+                os.remove(testfile)
+                os.remove(bookletfile)
+                os.remove(bookletfile + ".manifest")
+
+    def testAsyncImpositioning(self):
+        async def impose_all():
+            imposer = aio.Imposer(max_jobs=1)
+            jobs = []
+            for fn in self.testfiles:
+                with open(fn, "rb") as f:
+                    jobs.append(imposer.impose(f.read()))
+            return await asyncio.gather(*jobs)
+
+        for result, hash in zip(asyncio.run(impose_all()), self.testfiles.values()):
+            self.assertEqual(hashlib.md5(result).hexdigest(), hash)
+
+    def testAsyncStream(self):
+        async def stream(fn):
+            with open(fn, "rb") as f:
+                data = f.read()
+            return [chunk async for chunk in aio.Imposer().stream(data, chunk_size=1024)]
+
+        for fn, hash in self.testfiles.items():
+            chunks = asyncio.run(stream(fn))
+            self.assertTrue(all(len(chunk) == 1024 for chunk in chunks[:-1]))
+            self.assertEqual(hashlib.md5(b"".join(chunks)).hexdigest(), hash)
+
+    def testAsyncCancelKeepsSlot(self):
+        running = []
+        finish = Event()
+
+        def impose_bytes(data, args, cancel):
+            # ignores cancel, like a worker between two progress checks
+            running.append(data)
+            finish.wait()
+            running.remove(data)
+            return data
+
+        async def impose():
+            imposer = aio.Imposer(ThreadPoolExecutor(2), max_jobs=1)
+            first = asyncio.ensure_future(imposer.impose(b"1"))
+            await asyncio.sleep(0.05)
+            first.cancel()
+            second = asyncio.ensure_future(imposer.impose(b"2"))
+            await asyncio.sleep(0.05)
+            try:
+                # second job waits until the cancelled worker has finished
+                self.assertEqual(running, [b"1"])
+            finally:
+                finish.set()
+            return await second
+
+        with mock.patch.object(aio, "impose_bytes", impose_bytes):
+            self.assertEqual(asyncio.run(impose()), b"2")
+
+    def testAsyncInvalidArguments(self):
+        with open(next(iter(self.testfiles)), "rb") as f:
+            data = f.read()
+        with self.assertRaisesRegex(ValueError, "must be a power of 2"):
+            asyncio.run(aio.impose(data, cli.Arguments(pdf="", nup=3)))
+
+    def testAsyncStreamWhileWriting(self):
+        events = []
+        read = Event()
+
+        def write_imposed(data, args, out, cancel):
+            out.write(b"1" * 1024)
+            # the first chunk is read while the worker is still writing
+            events.append(read.wait(5))
+            try:
+                for _ in range(aio.STREAM_CHUNKS + 2):
+                    out.write(b"2" * 1024)
+            except core.Cancelled:
+                events.append("cancelled")
+                raise
+
+        async def stream(count):
+            chunks = []
+            generator = aio.Imposer().stream(b"", chunk_size=1024)
+            async for chunk in generator:
+                chunks.append(chunk)
+                read.set()
+                if len(chunks) == count:
+                    break
+            await generator.aclose()
+            return chunks
+
+        with mock.patch.object(aio, "write_imposed", write_imposed):
+            chunks = asyncio.run(stream(0))
+            self.assertEqual(chunks, [b"1" * 1024] + [b"2" * 1024] * (aio.STREAM_CHUNKS + 2))
+            self.assertEqual(events, [True])
+
+            # a reader that stops early makes the worker stop at its next write
+            events.clear()
+            read.clear()
+            self.assertEqual(asyncio.run(stream(1)), [b"1" * 1024])
+            self.assertEqual(events, [True, "cancelled"])
@@ -16,10 +16,24 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>
 
 import argparse
+import io
+import json
+import os
+import sys
+import time
+import zlib
+from collections import Counter
 
-from reportlab import pdfgen
+from pdfrw import IndirectPdfDict, PdfDict, PdfName, PdfReader
+from pdfrw.buildxobj import pagexobj
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen import canvas
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from impositioner.streamwriter import StreamWriter  # noqa: E402
+
 paperformats = {
     "a0": [2384, 3371],
     "a1": [1685, 2384],
@@ -39,6 +53,94 @@ paperformats = {
     "executive": [540, 720],
 }
 
+# TrueType font shipped with reportlab, embedded with --font
+EMBEDDED_FONT = ("Vera", "Vera.ttf")
+
+# width and height of generated images in pixels
+IMAGE_SIZE = 64
+
+
+def parse_formats(formats):
+    formats = formats.split(",")
+    for f in formats:
+        if f not in paperformats:
+            print(
+                "Unknown paper format: {}. Must be one of the following standard formats: {}".format(
+                    f, ", ".join(sorted(paperformats.keys()))
+                )
+            )
+            sys.exit(1)
+    return formats
+
+
+def parse_rotations(rotations):
+    values = rotations.split(",")
+    if any(r not in ("0", "90", "180", "270") for r in values):
+        print("Rotation must be one of 0, 90, 180, 270, is {}".format(rotations))
+        sys.exit(1)
+    return [int(r) for r in values]
+
+
+def create_templates(formats, orientation, bbox, font):
+    # draw static content of each format once with reportlab. every page of a
+    # format shares its template as form xobject.
+    buffer = io.BytesIO()
+    cv = canvas.Canvas(buffer)
+    for f in formats:
+        w, h = pagesize(f, orientation)
+        cv.setPageSize((w, h))
+        cv.setFont(font, 50)
+        cv.drawCentredString(w / 2, h / 2 + 100, orientation)
+        cv.drawCentredString(w / 2, h / 2 + 50, f)
+        if bbox:
+            cv.setLineWidth(2)
+            cv.setStrokeColorRGB(255, 0, 255)
+            cv.rect(5, 5, w - 10, h - 10)
+        cv.showPage()
+    cv.save()
+    pages = PdfReader(fdata=buffer.getvalue().decode("latin-1")).pages
+    return {f: pagexobj(page) for f, page in zip(formats, pages)}
+
+
+def create_image(index):
+    # flate compressed rgb gradient, with a different color for each index
+    blue = index * 37 % 256
+    pixels = bytes(
+        value for y in range(IMAGE_SIZE) for x in range(IMAGE_SIZE) for value in (x * 4 % 256, y * 4 % 256, blue)
+    )
+    return PdfDict(
+        indirect=True,
+        Type=PdfName.XObject,
+        Subtype=PdfName.Image,
+        Width=IMAGE_SIZE,
+        Height=IMAGE_SIZE,
+        ColorSpace=PdfName.DeviceRGB,
+        BitsPerComponent=8,
+        Filter=PdfName.FlateDecode,
+        stream=zlib.compress(pixels).decode("latin-1"),
+    )
+
+
+def pagesize(paperformat, orientation):
+    size = paperformats[paperformat]
+    if orientation == "landscape":
+        return list(reversed(size))
+    return list(size)
+
+
+def page_content(number, size, font, image):
+    # per page content only places the template and image and draws the
+    # page number
+    w, h = size
+    text = str(number)
+    ops = ["q /T Do Q"]
+    if image:
+        side = min(w, h) / 4
+        ops.append("q {0:.2f} 0 0 {0:.2f} {1:.2f} 20 cm /I Do Q".format(side, (w - side) / 2))
+    x = w / 2 - pdfmetrics.stringWidth(text, font, 100) / 2
+    ops.append("BT /N 100 Tf {:.2f} {:.2f} Td ({}) Tj ET".format(x, h / 2 - 50, text))
+    return "\n".join(ops)
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -51,7 +153,7 @@ def main():
         "format",
         action="store",
         type=str.lower,
-        help="standard paper format like A4, letter, ",
+        help="standard paper format like A4, letter, or comma separated list of formats used in turn, like a4,a5",
     )
     parser.add_argument(
         "--landscape",
@@ -60,40 +162,95 @@ def main():
         help="output in landscape (default: portrait)",
     )
     parser.add_argument("--bbox", "-b", action="store_true", help="draw bbox")
+    parser.add_argument(
+        "--rotate",
+        "-r",
+        action="store",
+        default="0",
+        help="comma separated list of page rotations used in turn, like 0,90 (default: 0)",
+    )
+    parser.add_argument(
+        "--images",
+        "-i",
+        action="store",
+        type=int,
+        default=0,
+        metavar="N",
+        help="embed an image on every page, using N different images in turn (default: 0)",
+    )
+    parser.add_argument("--font", "-f", action="store_true", help="embed TrueType font (default: standard font)")
+    parser.add_argument("--output", "-o", action="store", help="output file name (default: derived from arguments)")
     args = parser.parse_args()
 
-    if args.format not in paperformats:
-        print(
-            "Unknown paper format: {}. Must be one of the following standard formats: {}".format(
-                args.paperformat, ", ".join(sorted(paperformats.keys()))
-            )
-        )
+    start = time.perf_counter()
+    formats = parse_formats(args.format)
+    rotations = parse_rotations(args.rotate)
+    orientation = "landscape" if args.landscape else "portrait"
 
-    pagesize = paperformats[args.format]
-    orientation = "portrait"
-    if args.landscape:
-        pagesize = list(reversed(pagesize))
-        orientation = "landscape"
+    # page numbers always use a standard font, which needs no embedding
+    standard_font = canvas.Canvas(io.BytesIO()).getAvailableFonts()[0]
+    font = standard_font
+    if args.font:
+        pdfmetrics.registerFont(TTFont(*EMBEDDED_FONT))
+        font = EMBEDDED_FONT[0]
 
-    outfname = "{}_{}_{}.pdf".format(args.format, orientation, str(args.pages))
-    cv = canvas.Canvas(outfname, pagesize)
-    w, h = pagesize
-    font = cv.getAvailableFonts()[0]
+    # shared objects, referenced by every page
+    templates = create_templates(formats, orientation, args.bbox, font)
+    images = [create_image(i) for i in range(args.images)]
+    number_font = PdfDict(
+        indirect=True,
+        Type=PdfName.Font,
+        Subtype=PdfName.Type1,
+        BaseFont=PdfName(standard_font),
+        Encoding=PdfName.WinAnsiEncoding,
+    )
 
-    for i in range(1, args.pages + 1):
-        cv.setFont(font, 50)
-        cv.drawCentredString(w / 2, h / 2 + 100, orientation)
-        cv.drawCentredString(w / 2, h / 2 + 50, args.format)
-        cv.setFont(font, 100)
-        cv.drawCentredString(w / 2, h / 2 - 50, str(i))
-        if args.bbox:
-            cv.setLineWidth(2)
-            cv.setStrokeColorRGB(255, 0, 255)
-            cv.rect(5, 5, w - 10, h - 10)
-        cv.showPage()
-    cv.save()
+    # pages of the same format and image share their resources
+    resources = {}
+    for f in formats:
+        for image in range(len(images)) if images else [None]:
+            xobjects = PdfDict(T=templates[f])
+            if image is not None:
+                xobjects.I = images[image]
+            resources[f, image] = IndirectPdfDict(XObject=xobjects, Font=PdfDict(N=number_font))
+
+    outfname = args.output or "{}_{}_{}.pdf".format("-".join(formats), orientation, str(args.pages))
+    manifest = []
+    with open(outfname, "wb") as out:
+        writer = StreamWriter(out)
+        writer.start()
+        for i in range(1, args.pages + 1):
+            f = formats[(i - 1) % len(formats)]
+            rotation = rotations[(i - 1) % len(rotations)]
+            image = (i - 1) % len(images) if images else None
+            size = pagesize(f, orientation)
+            content = page_content(i, size, standard_font, image is not None)
+            writer.add_content_page([0, 0] + size, content, resources[f, image], rotation)
+            manifest.append({"number": i, "format": f, "size": size, "rotate": rotation, "image": image})
+        writer.close()
+
+    manifestfname = os.path.splitext(outfname)[0] + ".manifest.json"
+    with open(manifestfname, "w") as mf:
+        json.dump(
+            {
+                "file": outfname,
+                "bytes": os.path.getsize(outfname),
+                "seconds": round(time.perf_counter() - start, 3),
+                "page_count": args.pages,
+                "orientation": orientation,
+                "formats": Counter(page["format"] for page in manifest),
+                "rotations": Counter(page["rotate"] for page in manifest),
+                "images": len(images),
+                "font": font,
+                "font_embedded": args.font,
+                "pages": manifest,
+            },
+            mf,
+            indent=1,
+        )
 
     print("Created", outfname)
+    print("Created", manifestfname)
 
 
 if __name__ == "__main__":